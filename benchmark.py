@@ -0,0 +1,237 @@
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+import yaml
+from stats import Stats
+
+# Topics of a synthetic bag by kind: topic name, message type and default rate (Hz)
+TOPIC_KINDS = {
+    'gps': ('/vehicle/gps/fix', 'sensor_msgs/msg/NavSatFix', 20),
+    'imu': ('/imu', 'sensor_msgs/msg/Imu', 200),
+    'odom': ('/novatel/odom', 'nav_msgs/msg/Odometry', 50),
+}
+
+# Conversions timed by default, as bag_to_csv options
+CASES = {
+    'csv': {},
+    'csv-rclpy': {'fast_decode': False},
+    'csv-sqlite': {'backend': 'sqlite'},
+    'csv-gzip': {'compress': 'gzip'},
+    'parquet': {'output_format': 'parquet'},
+}
+
+# Builds a little-endian CDR payload; alignment is relative to the end of the
+# 4-byte encapsulation header
+class CdrWriter:
+    def __init__(self):
+        self.data = bytearray(b'\x00\x01\x00\x00')
+
+    def pack(self, fmt, size, *values):
+        self.data += bytes(-(len(self.data) - 4) % size)
+        self.data += struct.pack('<' + fmt, *values)
+
+    def doubles(self, *values):
+        self.pack(f'{len(values)}d', 8, *values)
+
+    def string(self, value):
+        encoded = value.encode() + b'\x00'
+        self.pack('I', 4, len(encoded))
+        self.data += encoded
+
+    def header(self, t, frame_id):
+        self.pack('iI', 4, t // 10**9, t % 10**9)
+        self.string(frame_id)
+
+def navsatfix(rng, t, i, frame_id='gps'):
+    writer = CdrWriter()
+    writer.header(t, frame_id)
+    writer.pack('b', 1, rng.choice([-1, 0, 2]))
+    writer.pack('H', 2, 1)
+    writer.doubles(42.29 + rng.random() * 1e-3, -83.69 + rng.random() * 1e-3, 250 + rng.random())
+    writer.doubles(*[rng.random() for _ in range(9)])
+    writer.pack('B', 1, 2)
+    return bytes(writer.data)
+
+def imu(rng, t, i, frame_id='imu_link'):
+    writer = CdrWriter()
+    writer.header(t, frame_id)
+    writer.doubles(0.0, 0.0, math.sin(i * 1e-3), math.cos(i * 1e-3))
+    writer.doubles(*[rng.random() for _ in range(9)])
+    writer.doubles(rng.gauss(0, 0.01), rng.gauss(0, 0.01), rng.gauss(0, 0.1))
+    writer.doubles(*[rng.random() for _ in range(9)])
+    writer.doubles(rng.gauss(0, 0.5), rng.gauss(0, 0.5), 9.81 + rng.gauss(0, 0.1))
+    writer.doubles(*[rng.random() for _ in range(9)])
+    return bytes(writer.data)
+
+def odometry(rng, t, i, frame_id='odom'):
+    writer = CdrWriter()
+    writer.header(t, frame_id)
+    writer.string('base_link')
+    writer.doubles(i * 0.1, i * 0.05, 0.0, 0.0, 0.0, math.sin(i * 1e-3), math.cos(i * 1e-3))
+    writer.doubles(*[rng.random() for _ in range(36)])
+    writer.doubles(10 + rng.gauss(0, 0.1), 0.0, 0.0, 0.0, 0.0, rng.gauss(0, 0.01))
+    writer.doubles(*[rng.random() for _ in range(36)])
+    return bytes(writer.data)
+
+ENCODERS = {'sensor_msgs/msg/NavSatFix': navsatfix, 'sensor_msgs/msg/Imu': imu, 'nav_msgs/msg/Odometry': odometry}
+
+# Write a synthetic rosbag2 sqlite3 bag at `path`: `duration` seconds of each
+# topic kind in `rates` ({kind: Hz}), split over `files` storage files by time.
+# Returns the number of messages.
+def make_bag(path, rates, duration=60.0, files=1, start_ns=1696274234_000_000_000, seed=0):
+    rng = random.Random(seed)
+    topics = []
+    messages = []
+    for topic_id, (kind, rate) in enumerate(rates.items(), 1):
+        name, msg_type, _ = TOPIC_KINDS[kind]
+        topics.append((topic_id, name, msg_type))
+        period = int(1e9 / rate)
+        for i in range(int(duration * rate)):
+            messages.append((start_ns + i * period, topic_id, msg_type, i))
+    messages.sort()
+
+    os.makedirs(path)
+    bag_name = os.path.basename(os.path.normpath(path))
+    per_file = math.ceil(len(messages) / files) if messages else 0
+    file_info = []
+    for index in range(files):
+        chunk = messages[index * per_file:(index + 1) * per_file]
+        file_name = f'{bag_name}_{index}.db3'
+        connection = sqlite3.connect(os.path.join(path, file_name))
+        connection.execute('CREATE TABLE schema(schema_version INTEGER PRIMARY KEY, ros_distro TEXT NOT NULL)')
+        connection.execute("INSERT INTO schema VALUES (3, 'humble')")
+        connection.execute('CREATE TABLE topics(id INTEGER PRIMARY KEY, name TEXT NOT NULL, type TEXT NOT NULL, '
+                           'serialization_format TEXT NOT NULL, offered_qos_profiles TEXT NOT NULL)')
+        connection.execute('CREATE TABLE messages(id INTEGER PRIMARY KEY, topic_id INTEGER NOT NULL, '
+                           'timestamp INTEGER NOT NULL, data BLOB NOT NULL)')
+        connection.execute('CREATE INDEX timestamp_idx ON messages (timestamp ASC)')
+        connection.executemany('INSERT INTO topics VALUES (?, ?, ?, ?, ?)',
+                               [(topic_id, name, msg_type, 'cdr', '') for topic_id, name, msg_type in topics])
+        connection.executemany('INSERT INTO messages(topic_id, timestamp, data) VALUES (?, ?, ?)',
+                               ((topic_id, t, ENCODERS[msg_type](rng, t, i)) for t, topic_id, msg_type, i in chunk))
+        connection.commit()
+        connection.close()
+        file_info.append({'path': file_name,
+                          'starting_time': {'nanoseconds_since_epoch': chunk[0][0] if chunk else start_ns},
+                          'duration': {'nanoseconds': chunk[-1][0] - chunk[0][0] if chunk else 0},
+                          'message_count': len(chunk)})
+
+    counts = {topic_id: 0 for topic_id, _, _ in topics}
+    for _, topic_id, _, _ in messages:
+        counts[topic_id] += 1
+    info = {
+        'version': 5,
+        'storage_identifier': 'sqlite3',
+        'duration': {'nanoseconds': messages[-1][0] - messages[0][0] if messages else 0},
+        'starting_time': {'nanoseconds_since_epoch': messages[0][0] if messages else start_ns},
+        'message_count': len(messages),
+        'topics_with_message_count': [
+            {'topic_metadata': {'name': name, 'type': msg_type, 'serialization_format': 'cdr',
+                                'offered_qos_profiles': ''},
+             'message_count': counts[topic_id]}
+            for topic_id, name, msg_type in topics],
+        'compression_format': '',
+        'compression_mode': '',
+        'relative_file_paths': [info['path'] for info in file_info],
+        'files': file_info,
+    }
+    with open(os.path.join(path, 'metadata.yaml'), 'w') as file:
+        yaml.safe_dump({'rosbag2_bagfile_information': info}, file, sort_keys=False)
+    return len(messages)
+
+# Peak resident set size in bytes of this process and of its finished children
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+# Convert a bag with bag_to_csv and report its stats; run in a fresh process so
+# the peak RSS belongs to this conversion alone
+def run_case(bagfile, output_dir, options):
+    from ros2bag_to_csv import bag_to_csv
+    stats = Stats()
+    started = time.perf_counter()
+    bag_to_csv(bagfile, output_dir, stats=stats, **options)
+    stats.stop()
+    report = stats.report()
+    report['wall_seconds'] = time.perf_counter() - started
+    report['peak_rss'] = peak_rss()
+    return report
+
+# Time each case on the bag `repeat` times; returns {case: [reports]}
+def run_benchmarks(bagfile, cases, repeat=1, work_dir=None):
+    results = {}
+    for name, options in cases.items():
+        results[name] = []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory(dir=work_dir) as output_dir:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                    results[name].append(executor.submit(run_case, bagfile, output_dir, options).result())
+    return results
+
+def print_results(results):
+    print(f"{'case':<12} {'seconds':>9} {'msgs/s':>10} {'MB/s':>8} {'peak MB':>9}  "
+          + ' '.join(f'{stage:>11}' for stage in Stats().stages))
+    for name, reports in results.items():
+        # The fastest run is the least disturbed by the rest of the machine
+        report = min(reports, key=lambda report: report['wall_seconds'])
+        print(f"{name:<12} {report['wall_seconds']:>9.3f} {report['messages_per_second'] or 0:>10.0f} "
+              f"{(report['bytes_per_second'] or 0) / 1e6:>8.2f} {report['peak_rss'] / 1e6:>9.1f}  "
+              + ' '.join(f'{seconds:>11.3f}' for seconds in report['stages'].values()))
+
+# Parse 'kind=Hz' rate arguments
+def parse_rates(values):
+    rates = {}
+    for value in values:
+        kind, _, rate = value.partition('=')
+        if kind not in TOPIC_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown topic kind '{kind}' (choose from {', '.join(TOPIC_KINDS)})")
+        rates[kind] = float(rate) if rate else TOPIC_KINDS[kind][2]
+    return rates
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bag_to_csv on synthetic bags.')
+    parser.add_argument('--topics', nargs='+', default=list(TOPIC_KINDS), metavar='KIND[=HZ]',
+                        help=f"Topic kinds in the bag and their rates ({', '.join(TOPIC_KINDS)}; "
+                             "default rates: " + ', '.join(f'{kind}={rate:g}' for kind, (_, _, rate)
+                                                            in TOPIC_KINDS.items()) + ').')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds of data in the bag.')
+    parser.add_argument('--files', type=int, default=1, help='Number of storage files to split the bag into.')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES),
+                        help='Conversions to time.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case; the fastest is reported.')
+    parser.add_argument('--bag', help='Keep the generated bag at this path (reused if it exists).')
+    parser.add_argument('--work-dir', help='Directory for the bag and outputs (default: the system temp dir).')
+    parser.add_argument('--json', metavar='PATH', help='Write every run report to a JSON file.')
+    args = parser.parse_args()
+
+    rates = parse_rates(args.topics)
+    tmp_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        bagfile = args.bag or os.path.join(tmp_dir, 'synthetic')
+        if not os.path.exists(bagfile):
+            started = time.perf_counter()
+            count = make_bag(bagfile, rates, args.duration, args.files)
+            print(f'Generated {count} messages in {time.perf_counter() - started:.1f} s: {bagfile}')
+        results = run_benchmarks(bagfile, {name: CASES[name] for name in args.cases}, args.repeat, tmp_dir)
+        print_results(results)
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump({'rates': rates, 'duration': args.duration, 'files': args.files, 'results': results},
+                          file, indent=2)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
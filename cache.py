@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# Source files of the converter; any change to them invalidates the cache
+SOURCES = ['ros2bag_to_csv.py', 'cdr.py', 'writers.py', 'cache.py']
+
+# Hash of the converter sources, standing in for a version number
+def converter_version():
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCES:
+        with open(os.path.join(directory, name), 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+# Key of a conversion: a hash of the converter version, the size and mtime of
+# every bag file, the bag name (which prefixes the outputs) and the options
+# that change the output
+def cache_key(paths, bag_name, options):
+    files = []
+    for path in paths:
+        stat = os.stat(path)
+        files.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    key = {'version': converter_version(), 'files': files, 'bag': bag_name, 'options': options}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+# Copy the cached outputs of `key` into output_dir, skipping files that are
+# already there unchanged. Returns False if nothing (complete) is cached under
+# `key`; the outputs then have to be converted again.
+def restore(cache_dir, key, output_dir):
+    entry = os.path.join(cache_dir, key)
+    try:
+        # Mark the entry as recently used, so that it is the last to be evicted
+        os.utime(entry)
+        for name in os.listdir(entry):
+            source = os.path.join(entry, name)
+            target = os.path.join(output_dir, name)
+            cached, existing = os.stat(source), os.stat(target) if os.path.exists(target) else None
+            if existing is None or (existing.st_size, existing.st_mtime_ns) != (cached.st_size, cached.st_mtime_ns):
+                shutil.copy2(source, target)
+    except FileNotFoundError:
+        # Not cached, or evicted by another process while being restored
+        return False
+    return True
+
+# Store copies of the files `names` of output_dir under `key`. Outputs are
+# copied rather than linked since a later conversion rewrites them in place.
+def store(cache_dir, key, output_dir, names):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp')
+    for name in names:
+        shutil.copy2(os.path.join(output_dir, name), os.path.join(tmp_dir, name))
+    try:
+        os.rename(tmp_dir, os.path.join(cache_dir, key))
+    except OSError:
+        # Another process stored the same conversion first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# Remove the least recently used entries until the cache holds at most
+# max_size bytes
+def evict(cache_dir, max_size):
+    entries = []
+    total = 0
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        if key.startswith('.tmp') or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        except FileNotFoundError:
+            # Evicted by another process meanwhile
+            continue
+        total += size
+    for _, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
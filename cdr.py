@@ -0,0 +1,264 @@
+import struct
+import numpy as np
+
+# struct format code and size (which is also the CDR alignment) of ROS primitive types
+PRIMITIVES = {
+    'boolean': ('?', 1), 'float': ('f', 4), 'double': ('d', 8),
+    'int8': ('b', 1), 'uint8': ('B', 1), 'int16': ('h', 2), 'uint16': ('H', 2),
+    'int32': ('i', 4), 'uint32': ('I', 4), 'int64': ('q', 8), 'uint64': ('Q', 8),
+}
+
+# numpy dtypes rclpy uses for fixed-size arrays of each primitive type
+DTYPES = {
+    'float': np.float32, 'double': np.float64,
+    'int8': np.int8, 'uint8': np.uint8, 'int16': np.int16, 'uint16': np.uint16,
+    'int32': np.int32, 'uint32': np.uint32, 'int64': np.int64, 'uint64': np.uint64,
+}
+
+UINT32 = struct.Struct('<I')
+
+# Split a ROS field type into (element type, array size), array size None for
+# scalars; returns None for anything without a fixed layout (sequences,
+# wstrings, arrays of strings, booleans or messages, byte/char types)
+def parse_type(ros_type):
+    if ros_type == 'string' or ros_type.startswith('string<='):
+        return 'string', None
+    if ros_type in PRIMITIVES:
+        return ros_type, None
+    if ros_type.endswith(']') and '[' in ros_type:
+        element, size = ros_type[:-1].split('[')
+        if element in DTYPES and size.isdigit():
+            return element, int(size)
+    return None
+
+# Compile the struct for a run of fixed-size items, given the CDR alignment phase
+# (offset past the 4-byte encapsulation header, mod 8) the run starts at
+def run_struct(items, phase):
+    fmt = '<'
+    offset = phase
+    for element, count in items:
+        code, size = PRIMITIVES[element]
+        pad = -offset % size
+        if pad:
+            fmt += f'{pad}x'
+        fmt += f'{count}{code}'
+        offset += pad + size * count
+    return struct.Struct(fmt)
+
+# Build a decoder that reads a CDR (little-endian) payload straight into a row
+# in `columns` order, without building a message object. `fields` maps the
+# flattened field paths to their ROS types in declaration order, as returned by
+# message_fields(). Fixed-size runs between strings are read with one
+# precompiled struct per alignment phase; strings are read inline.
+#
+# The decoder returns (stamp, row), or None for payloads it cannot handle (big
+# endian or truncated) so the caller can fall back to rclpy. compile_decoder returns None for
+# types without a fixed layout or without a header stamp.
+def compile_decoder(fields, columns):
+    if 'header.stamp.sec' not in fields or 'header.stamp.nanosec' not in fields:
+        return None
+
+    # Group the fields into runs of fixed-size items separated by strings
+    steps = []
+    run = []
+    index = {}
+    count = 0
+    for path, ros_type in fields.items():
+        parsed = parse_type(ros_type)
+        if parsed is None:
+            return None
+        element, size = parsed
+        if element == 'string':
+            if run:
+                steps.append(run)
+                run = []
+            steps.append('string')
+            index[path] = (count, None)
+            count += 1
+        else:
+            run.append((element, size or 1))
+            index[path] = (count, size)
+            count += size or 1
+    if run:
+        steps.append(run)
+    steps = [step if step == 'string' else [run_struct(step, phase) for phase in range(8)]
+             for step in steps]
+
+    # Map every output column to a position in the decoded values
+    order = []
+    arrays = []
+    for i, column in enumerate(columns):
+        if column in index:
+            start, size = index[column]
+            order.append(start)
+            if size is not None:
+                arrays.append((i, start, start + size, DTYPES[fields[column][:fields[column].index('[')]]))
+        else:
+            name, element = column.rsplit('.', 1)
+            order.append(index[name][0] + int(element))
+    sec = index['header.stamp.sec'][0]
+    nanosec = index['header.stamp.nanosec'][0]
+
+    def decode(data):
+        if data[1] != 1:
+            return None
+        values = []
+        pos = 4
+        try:
+            for step in steps:
+                if step == 'string':
+                    pos += -(pos - 4) % 4
+                    length = UINT32.unpack_from(data, pos)[0]
+                    pos += 4
+                    if pos + length > len(data):
+                        return None
+                    values.append(bytes(data[pos:pos + length - 1]).decode())
+                    pos += length
+                else:
+                    unpacker = step[(pos - 4) & 7]
+                    values.extend(unpacker.unpack_from(data, pos))
+                    pos += unpacker.size
+        except struct.error:
+            # Truncated payload
+            return None
+        row = [values[i] for i in order]
+        for i, start, end, dtype in arrays:
+            row[i] = np.array(values[start:end], dtype=dtype)
+        return values[sec] + values[nanosec] * 1e-9, row
+
+    return decode
+
+# numpy dtype strings (little-endian) of ROS primitive types
+NUMPY_TYPES = {
+    'boolean': '?', 'float': '<f4', 'double': '<f8',
+    'int8': 'i1', 'uint8': 'u1', 'int16': '<i2', 'uint16': '<u2',
+    'int32': '<i4', 'uint32': '<u4', 'int64': '<i8', 'uint64': '<u8',
+}
+
+# Build a decoder for a whole block of CDR payloads of one message type. It
+# finds the lengths of the string fields for all payloads at once, groups the
+# payloads that share the same string lengths (and so the same byte layout),
+# and reads each group with a single numpy structured-array view.
+#
+# The decoder returns (stamps, values): the stamps as a list and one list of
+# values per column of `columns`, or None if any payload cannot be handled
+# (big endian or truncated) so the caller can fall back to per-message
+# decoding. compile_batch_decoder returns None for the same types as
+# compile_decoder.
+def compile_batch_decoder(fields, columns):
+    if 'header.stamp.sec' not in fields or 'header.stamp.nanosec' not in fields:
+        return None
+
+    items = []
+    index = {}
+    for path, ros_type in fields.items():
+        parsed = parse_type(ros_type)
+        if parsed is None:
+            return None
+        index[path] = len(items)
+        items.append(parsed)
+    last_string = max([i for i, (element, size) in enumerate(items) if element == 'string'], default=-1)
+
+    # Structured dtype of the payloads whose strings have the given lengths
+    # (including the terminating null), and the position of each item in it
+    dtypes = {}
+
+    def layout(lengths):
+        if lengths in dtypes:
+            return dtypes[lengths]
+        names, formats, offsets = [], [], []
+        pos = 4
+        strings = iter(lengths)
+        for i, (element, size) in enumerate(items):
+            if element == 'string':
+                pos += -(pos - 4) % 4 + 4
+                length = next(strings)
+                if length > 1:
+                    names.append(f'f{i}')
+                    formats.append(f'S{length - 1}')
+                    offsets.append(pos)
+                pos += length
+            else:
+                width = PRIMITIVES[element][1]
+                pos += -(pos - 4) % width
+                names.append(f'f{i}')
+                formats.append(NUMPY_TYPES[element] if size is None else (NUMPY_TYPES[element], (size,)))
+                offsets.append(pos)
+                pos += width * (size or 1)
+        dtypes[lengths] = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': pos})
+        return dtypes[lengths]
+
+    # Where each output column comes from: (item, element of an expanded array or None)
+    sources = []
+    for column in columns:
+        if column in index:
+            sources.append((index[column], None))
+        else:
+            name, element = column.rsplit('.', 1)
+            sources.append((index[name], int(element)))
+    sec = index['header.stamp.sec']
+    nanosec = index['header.stamp.nanosec']
+
+    def decode_batch(payloads):
+        count = len(payloads)
+        sizes = np.fromiter(map(len, payloads), dtype=np.int64, count=count)
+        starts = np.zeros(count, dtype=np.int64)
+        np.cumsum(sizes[:-1], out=starts[1:])
+        buffer = np.frombuffer(b''.join(payloads), dtype=np.uint8)
+        if not (buffer[starts + 1] == 1).all():
+            return None
+
+        # Walk the items up to the last string for every payload at once
+        pos = np.full(count, 4, dtype=np.int64)
+        lengths = []
+        for element, size in items[:last_string + 1]:
+            if element == 'string':
+                pos += -(pos - 4) % 4
+                if ((pos + 4) > sizes).any():
+                    return None
+                length = buffer[(starts + pos)[:, None] + np.arange(4)].copy().view('<u4')[:, 0].astype(np.int64)
+                lengths.append(length)
+                pos += 4 + length
+            else:
+                width = PRIMITIVES[element][1]
+                pos += -(pos - 4) % width + width * (size or 1)
+
+        if lengths:
+            keys, groups = np.unique(np.stack(lengths, axis=1), axis=0, return_inverse=True)
+            groups = groups.ravel()
+        else:
+            keys, groups = np.zeros((1, 0), dtype=np.int64), np.zeros(count, dtype=np.int64)
+
+        # Decode each layout group and scatter it back into message order
+        values = [None] * len(items)
+        for group, key in enumerate(keys):
+            members = np.flatnonzero(groups == group)
+            dtype = layout(tuple(key.tolist()))
+            if (sizes[members] < dtype.itemsize).any():
+                return None
+            block = buffer[(starts[members])[:, None] + np.arange(dtype.itemsize)].view(dtype)[:, 0]
+            for i, (element, size) in enumerate(items):
+                if element == 'string':
+                    name = f'f{i}'
+                    decoded = (np.char.decode(block[name], 'utf-8') if name in dtype.names
+                               else np.full(len(members), ''))
+                    if values[i] is None:
+                        values[i] = np.empty(count, dtype=object)
+                    values[i][members] = decoded.tolist()
+                else:
+                    if values[i] is None:
+                        values[i] = np.empty((count,) + block.dtype[f'f{i}'].shape, dtype=block.dtype[f'f{i}'].base)
+                    values[i][members] = block[f'f{i}']
+
+        stamps = values[sec].astype(np.float64) + values[nanosec] * 1e-9
+        columns_out = []
+        for i, element in sources:
+            if element is not None:
+                columns_out.append(values[i][:, element].tolist())
+            elif values[i].ndim > 1:
+                columns_out.append(list(values[i]))
+            else:
+                columns_out.append(values[i].tolist())
+        return stamps.tolist(), columns_out
+
+    return decode_batch
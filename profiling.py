@@ -0,0 +1,68 @@
+import collections
+import contextlib
+import cProfile
+import sys
+import threading
+import time
+
+# Samples the stacks of every other thread every `interval` seconds and counts
+# them in collapsed form ('thread;file:function;...'), as read by flamegraph
+# tools
+class StackSampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_filename}:{code.co_name}')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as file:
+            for stack, count in self.counts.most_common():
+                file.write(f'{stack} {count}\n')
+
+# Profile the calling thread with cProfile while in the block and dump the
+# stats to `path` (if given); with stacks_path, also sample the stacks of all
+# threads into a collapsed-stack file. The files are written even if the
+# block raises or exits.
+@contextlib.contextmanager
+def profiled(path=None, stacks_path=None, interval=0.005):
+    profile = cProfile.Profile() if path else None
+    sampler = StackSampler(interval) if stacks_path else None
+    if sampler is not None:
+        sampler.start()
+    if profile is not None:
+        profile.enable()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(path)
+        if sampler is not None:
+            sampler.stop()
+            sampler.write(stacks_path)
+        print(f'Profiled {time.perf_counter() - started:.3f} s: '
+              + ', '.join(p for p in (path, stacks_path) if p), file=sys.stderr)
@@ -1,69 +1,1365 @@
 import argparse
+import collections
+import concurrent.futures
 import csv
+import datetime
+import decimal
+import fnmatch
+import glob
+import heapq
+import itertools
+import json
+import operator
 import os
-import rosbag2_py
+import pathlib
+import queue
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import yaml
 from rclpy.serialization import deserialize_message
 from rosidl_runtime_py.utilities import get_message
+import cache
+from cdr import compile_batch_decoder, compile_decoder
+from profiling import profiled
+from stats import Stats, instrument, timed_batches
+from writers import CsvTopicWriter, OutputOptions, concatenate_parquet, open_csv_file, open_writer, output_path
 
-# Recursively extract all fields from a ROS message
-def extract_fields(msg, prefix=''):
+# Compiled flatteners, keyed by (message class, expand_arrays)
+_flatteners = {}
+
+# Element types whose fixed-size arrays can be expanded into one column per element
+NUMERIC_TYPES = {'float', 'double', 'int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'int64', 'uint64'}
+
+# attrgetter returning a tuple for any number of attribute paths
+def tuple_getter(paths):
+    if not paths:
+        return lambda msg: ()
+    if len(paths) == 1:
+        single = operator.attrgetter(paths[0])
+        return lambda msg: (single(msg),)
+    return operator.attrgetter(*paths)
+
+# Map each data field of a message class, nested messages flattened to dotted
+# paths, to its ROS field type
+def message_fields(msg_class):
     fields = {}
-    for attr in dir(msg):
-        if not attr.startswith('_'):
-            value = getattr(msg, attr)
-            if hasattr(value, '__slots__'):
-                fields.update(extract_fields(value, prefix=f'{prefix}{attr}.'))
+
+    def walk(value, prefix):
+        for attr, ros_type in value.get_fields_and_field_types().items():
+            child = getattr(value, attr)
+            if hasattr(child, '__slots__'):
+                walk(child, f'{prefix}{attr}.')
             else:
-                fields[f'{prefix}{attr}'] = value
+                fields[f'{prefix}{attr}'] = ros_type
+
+    walk(msg_class(), '')
     return fields
 
-def bag_to_csv(bagfile, output_dir):
-    reader = rosbag2_py.SequentialReader()
+# Collect the constants (e.g. COVARIANCE_TYPE_KNOWN, status.STATUS_FIX) of a
+# message class and its nested messages
+def message_constants(msg_class):
+    constants = {}
 
-    storage_options = rosbag2_py.StorageOptions(uri=bagfile, storage_id="sqlite3")
-    converter_options = rosbag2_py.ConverterOptions(input_serialization_format="cdr",
-                                                    output_serialization_format="cdr")
+    def walk(value, prefix):
+        field_names = value.get_fields_and_field_types()
+        for attr in dir(value):
+            if attr.startswith('_') or attr == 'SLOT_TYPES':
+                continue
+            child = getattr(value, attr)
+            if attr in field_names:
+                if hasattr(child, '__slots__'):
+                    walk(child, f'{prefix}{attr}.')
+            elif isinstance(child, (bool, int, float, str)):
+                constants[f'{prefix}{attr}'] = child
 
-    reader.open(storage_options, converter_options)
+    walk(msg_class(), '')
+    return constants
 
-    topics_and_types = reader.get_all_topics_and_types()
+# Build the column names, their ROS field types and a row function for a message
+# class. Columns are the message's data fields in sorted order; the field walk
+# happens once here and each row is read with a single attrgetter.
+# With expand_arrays, a fixed-size numeric array such as position_covariance
+# becomes the columns position_covariance.0 ... position_covariance.8.
+def compile_flattener(msg_class, expand_arrays=False):
+    fields = message_fields(msg_class)
+    columns, types = [], []
+    scalar_paths, scalar_indices = [], []
+    array_paths, array_spans = [], []
+    for name in sorted(fields):
+        match = re.fullmatch(r'(\w+)\[(\d+)\]', fields[name])
+        if expand_arrays and match and match.group(1) in NUMERIC_TYPES:
+            size = int(match.group(2))
+            array_paths.append(name)
+            array_spans.append((len(columns), len(columns) + size))
+            columns += [f'{name}.{i}' for i in range(size)]
+            types += [match.group(1)] * size
+        else:
+            scalar_paths.append(name)
+            scalar_indices.append(len(columns))
+            columns.append(name)
+            types.append(fields[name])
+    scalar_getter = tuple_getter(scalar_paths)
+    array_getter = tuple_getter(array_paths)
 
-    # Create a dictionary mapping topic names to types
-    topic_types = {topic_metadata.name: topic_metadata.type for topic_metadata in topics_and_types}
+    if not array_paths:
+        return columns, types, lambda msg: list(scalar_getter(msg))
 
-    # Create a CSV writer for each type
-    writers = {}
-    bag_name = os.path.basename(os.path.normpath(bagfile))
-    for topic, msg_type in topic_types.items():
-        if 'gps_msgs' in msg_type:
-            msg_type = 'sensor_msgs/msg/NavSatFix'
-        csvfile = f"{output_dir}/{bag_name}{topic.replace('/', '_')}.csv"
-        file = open(csvfile, 'w', newline='')
-        writer = csv.writer(file)
-        writer.writerow(["stamp", "topic"] + sorted(extract_fields(get_message(msg_type)())))
-        writers[topic] = (file, writer)
-
-    while reader.has_next():
-        (topic, data, t) = reader.read_next()
-        msg_type = topic_types[topic]
-        if 'gps_msgs' in msg_type:
-            msg_type = 'sensor_msgs/msg/NavSatFix'
-        msg = deserialize_message(data, get_message(msg_type))
+    template = [None] * len(columns)
+
+    def flatten(msg):
+        row = template[:]
+        for i, value in zip(scalar_indices, scalar_getter(msg)):
+            row[i] = value
+        for (i, j), value in zip(array_spans, array_getter(msg)):
+            row[i:j] = value.tolist()
+        return row
+
+    return columns, types, flatten
+
+# Return the cached (columns, types, flatten) triple for a message class
+def get_flattener(msg_class, expand_arrays=False):
+    flattener = _flatteners.get((msg_class, expand_arrays))
+    if flattener is None:
+        flattener = _flatteners[msg_class, expand_arrays] = compile_flattener(msg_class, expand_arrays)
+    return flattener
+
+# Compiled CDR decoders (None where the type has no fixed layout), keyed by
+# (message class, expand_arrays)
+_decoders = {}
+
+# Return the cached CDR decoder for a message class, producing rows in the same
+# column order as its flattener
+def get_decoder(msg_class, expand_arrays=False):
+    key = (msg_class, expand_arrays)
+    if key not in _decoders:
+        columns, types, flatten = get_flattener(msg_class, expand_arrays)
+        _decoders[key] = compile_decoder(message_fields(msg_class), columns)
+    return _decoders[key]
+
+# Compiled block decoders (None where the type has no fixed layout), keyed by
+# (message class, expand_arrays)
+_batch_decoders = {}
+
+# Return the cached block decoder for a message class, producing columns in the
+# same order as its flattener
+def get_batch_decoder(msg_class, expand_arrays=False):
+    key = (msg_class, expand_arrays)
+    if key not in _batch_decoders:
+        columns, types, flatten = get_flattener(msg_class, expand_arrays)
+        _batch_decoders[key] = compile_batch_decoder(message_fields(msg_class), columns)
+    return _batch_decoders[key]
+
+# Input settings shared by every topic of a conversion: batch_size is the number
+# of payloads per topic decoded together (0 or 1 decodes message by message)
+# backend the reader ('rosbag2' or 'sqlite'), decompress_threads the size of
+# the sqlite reader's decompression pool (None for one per CPU), decode_workers
+# the number of decode threads in pipelined mode (0 runs the plain read loop),
+# queue_size the number of decode blocks the pipeline holds in flight,
+# read_size the number of messages (of all topics) read from storage at a time
+# and tmp_dir where the sqlite reader puts decompressed copies of storage files
+# (None for the system temp dir)
+ReadOptions = collections.namedtuple('ReadOptions', ['fast_decode', 'batch_size', 'backend', 'decompress_threads',
+                                                     'decode_workers', 'queue_size', 'read_size', 'tmp_dir'],
+                                     defaults=[True, 4096, 'rosbag2', None, 0, 8, 1024, None])
+
+# Everything the read loop needs for one topic, resolved when the topic is opened
+TopicPlan = collections.namedtuple('TopicPlan', ['msg_type', 'msg_class', 'columns', 'flatten', 'decode',
+                                                 'decode_batch', 'writer', 'receive_time', 'deserialize'])
+
+# gps_msgs topics are read as NavSatFix
+def resolve_type(msg_type):
+    if 'gps_msgs' in msg_type:
+        return 'sensor_msgs/msg/NavSatFix'
+    return msg_type
+
+# Resolve the message class, column order and decoders for a topic
+def topic_plan(topic, msg_type, output, read, writer=None):
+    msg_type = resolve_type(msg_type)
+    msg_class = get_message(msg_type)
+    columns, types, flatten = get_flattener(msg_class, output.expand_arrays)
+    decode = get_decoder(msg_class, output.expand_arrays) if read.fast_decode else None
+    decode_batch = (get_batch_decoder(msg_class, output.expand_arrays)
+                    if read.fast_decode and read.batch_size > 1 else None)
+    return TopicPlan(msg_type, msg_class, columns, flatten, decode, decode_batch, writer, output.receive_time,
+                     deserialize_message)
+
+# Plan a topic, open its output file and write its metadata sidecar
+def open_topic(topic, msg_type, output_dir, bag_name, output, read, offset=None):
+    plan = topic_plan(topic, msg_type, output, read)
+    types = get_flattener(plan.msg_class, output.expand_arrays)[1]
+    path = f"{output_dir}/{bag_name}{topic.replace('/', '_')}"
+    header, header_types = ["stamp", "topic"] + plan.columns, ['double', 'string'] + types
+    # Intermediate outputs that are merged later lead with the bag receive time
+    if output.receive_time:
+        header, header_types = ["receive_time"] + header, ['int64'] + header_types
+    writer = open_writer(path, header, header_types, output, offset)
+
+    # Constants never change from row to row, so they are written once beside the data
+    with open(f'{path}.meta.json', 'w') as file:
+        json.dump({'topic': topic, 'type': plan.msg_type, 'constants': message_constants(plan.msg_class)},
+                  file, indent=2)
+    return plan._replace(writer=writer)
+
+# Check a topic name against glob patterns; a 're:' prefix marks a regular expression
+def topic_matches(topic, patterns):
+    for pattern in patterns:
+        if pattern.startswith('re:'):
+            if re.fullmatch(pattern[3:], topic):
+                return True
+        elif fnmatch.fnmatchcase(topic, pattern):
+            return True
+    return False
+
+# Keep the topics matched by `topics` (all if empty) and not matched by `exclude_topics`
+def select_topics(topic_types, topics=None, exclude_topics=None):
+    return {topic: msg_type for topic, msg_type in topic_types.items()
+            if (not topics or topic_matches(topic, topics))
+            and not (exclude_topics and topic_matches(topic, exclude_topics))}
+
+# Convert a rosbag2 time point or duration to nanoseconds
+def to_ns(value):
+    if hasattr(value, 'nanoseconds'):
+        return value.nanoseconds
+    if isinstance(value, datetime.timedelta):
+        return value // datetime.timedelta(microseconds=1) * 1000
+    return round(value.timestamp() * 1e6) * 1000
+
+# Convert a time bound to nanoseconds: '+N' is N seconds after the bag start,
+# anything else is seconds since the epoch
+def resolve_time(value, reader):
+    if value is None:
+        return None
+    if isinstance(value, str) and value.startswith('+'):
+        return reader.start_ns() + int(decimal.Decimal(value[1:]) * 10**9)
+    return int(decimal.Decimal(str(value)) * 10**9)
+
+# argparse type of --start/--end: epoch seconds, or '+SECONDS' from the bag start
+def time_bound(value):
+    if not re.fullmatch(r'\+?(\d+(\.\d*)?|\.\d+)', value):
+        raise argparse.ArgumentTypeError(f"invalid time '{value}' (expected epoch seconds or '+SECONDS')")
+    return value
+
+# Storage plugin for each bag file extension
+STORAGE_IDS = {'.db3': 'sqlite3', '.mcap': 'mcap'}
+
+# The rosbag2_bagfile_information section of a bag's metadata.yaml, or None
+def read_bag_info(bagfile):
+    metadata_path = os.path.join(bagfile, 'metadata.yaml')
+    if not os.path.isfile(metadata_path):
+        return None
+    with open(metadata_path) as file:
+        return yaml.safe_load(file)['rosbag2_bagfile_information']
+
+# Storage plugin of a bag: the storage_identifier in its metadata.yaml, or else
+# the extension of its (first) storage file
+def detect_storage_id(bagfile):
+    info = read_bag_info(bagfile)
+    if info is not None:
+        if info.get('storage_identifier'):
+            return info['storage_identifier']
+        files = info.get('relative_file_paths') or []
+    elif os.path.isdir(bagfile):
+        files = sorted(os.listdir(bagfile))
+    else:
+        files = [bagfile]
+    for name in files:
+        # Compressed storage files look like bag_0.mcap.zstd
+        root, extension = os.path.splitext(name)
+        if extension not in STORAGE_IDS:
+            root, extension = os.path.splitext(root)
+        if extension in STORAGE_IDS:
+            return STORAGE_IDS[extension]
+    return 'sqlite3'
+
+# Paths of the storage files of a bag, in recording order
+def storage_files(bagfile):
+    info = read_bag_info(bagfile)
+    if info is not None:
+        return [os.path.join(bagfile, name) for name in info['relative_file_paths']]
+    if os.path.isdir(bagfile):
+        return sorted(path for pattern in ('*.db3', '*.mcap', '*.db3.zstd', '*.mcap.zstd')
+                      for path in glob.glob(os.path.join(bagfile, pattern)))
+    return [bagfile]
+
+# Reads a bag through rosbag2_py. Topic filters and seeks are handed to the
+# storage plugin, so MCAP bags only decompress the chunks that hold them.
+# Compressed bags go through rosbag2's SequentialCompressionReader, which
+# decompresses serially; `files` (a single storage file) is only supported for
+# uncompressed bags.
+class Rosbag2Reader:
+    def __init__(self, bagfile, read, files=None):
+        import rosbag2_py
+        self.rosbag2_py = rosbag2_py
+        if bag_compression(bagfile)[0] is not None:
+            if files:
+                raise ValueError('rosbag2 cannot read single storage files of a compressed bag')
+            self.reader = rosbag2_py.SequentialCompressionReader()
+        else:
+            self.reader = rosbag2_py.SequentialReader()
+
+        uri = files[0] if files else bagfile
+        storage_options = rosbag2_py.StorageOptions(uri=uri, storage_id=detect_storage_id(uri))
+        converter_options = rosbag2_py.ConverterOptions(input_serialization_format="cdr",
+                                                        output_serialization_format="cdr")
+
+        self.reader.open(storage_options, converter_options)
+
+    # Map topic names to message types
+    def topic_types(self):
+        return {topic_metadata.name: topic_metadata.type for topic_metadata in self.reader.get_all_topics_and_types()}
+
+    # Message count per topic from the bag metadata
+    def message_counts(self):
+        return {info.topic_metadata.name: info.message_count
+                for info in self.reader.get_metadata().topics_with_message_count}
+
+    # Bag start time in nanoseconds since the epoch
+    def start_ns(self):
+        return to_ns(self.reader.get_metadata().starting_time)
+
+    # Bag end time (timestamp of the last message) in nanoseconds since the epoch
+    def end_ns(self):
+        metadata = self.reader.get_metadata()
+        return to_ns(metadata.starting_time) + to_ns(metadata.duration)
+
+    # Only read these topics
+    def set_topics(self, topics):
+        self.reader.set_filter(self.rosbag2_py.StorageFilter(topics=list(topics)))
+
+    def seek(self, t):
+        self.reader.seek(t)
+
+    # Yield lists of up to batch_size (topic, data, t) tuples in time order
+    def read_batches(self, batch_size=1024):
+        reader = self.reader
+        while reader.has_next():
+            batch = []
+            while len(batch) < batch_size and reader.has_next():
+                batch.append(reader.read_next())
+            yield batch
+
+    # rosbag2 closes the bag when the reader is collected
+    def close(self):
+        self.reader = None
+
+# zstandard is only needed for compressed bags
+def zstd_module():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstandard is required to read compressed bags (pip install zstandard)')
+    return zstandard
+
+# (compression format, compression mode) of a bag, e.g. ('zstd', 'FILE'), or (None, None)
+def bag_compression(bagfile):
+    info = read_bag_info(bagfile)
+    if info is not None and info.get('compression_format'):
+        return info['compression_format'], (info.get('compression_mode') or 'FILE').upper()
+    if bagfile.endswith('.zstd'):
+        return 'zstd', 'FILE'
+    return None, None
+
+# Number of storage files of a FILE-compressed bag decompressed at a time: the
+# one being read and the next
+FILE_LOOKAHEAD = 2
+
+# Decompress a zstd-compressed storage file into tmp_dir; returns the new path
+def decompress_file(path, tmp_dir):
+    zstandard = zstd_module()
+    target = os.path.join(tmp_dir, os.path.basename(path)[:-len('.zstd')])
+    with open(path, 'rb') as source, open(target, 'wb') as destination:
+        zstandard.ZstdDecompressor().copy_stream(source, destination)
+    return target
+
+# Decompress the payloads of a batch of zstd-compressed messages. zstandard
+# releases the GIL, so batches decompress in parallel on a thread pool.
+def decompress_batch(batch):
+    zstandard = zstd_module()
+    decompressor = zstandard.ZstdDecompressor()
+    messages = []
+    for topic, data, t in batch:
+        try:
+            data = decompressor.decompress(data)
+        except zstandard.ZstdError:
+            # Frames written without a content size
+            data = decompressor.decompressobj().decompress(data)
+        messages.append((topic, data, t))
+    return messages
+
+# Reads the .db3 files of a sqlite3 bag directly with the sqlite3 module, a
+# large fetchmany() at a time, without loading rosbag2_py. `files` restricts
+# reading to some of the bag's storage files.
+#
+# Compressed bags are decompressed on a thread pool ahead of use: in FILE mode
+# a storage file starts decompressing into read.tmp_dir when it is first
+# needed, together with the next one, and its decompressed copy is deleted once
+# it has been read (or when the reader is closed); files that end before the
+# start of the read are skipped. Metadata comes from
+# metadata.yaml when it has it, so it needs no decompression. In MESSAGE mode
+# upcoming batches of payloads are decompressed while the current one is being
+# decoded and written.
+class SqliteBagReader:
+    def __init__(self, bagfile, read, files=None):
+        self.info = read_bag_info(bagfile)
+        self.paths = files or storage_files(bagfile)
+        self.compression, self.compression_mode = bag_compression(bagfile)
+        if self.compression not in (None, 'zstd'):
+            raise ValueError(f'Unsupported bag compression: {self.compression}')
+        self.threads = read.decompress_threads or os.cpu_count()
+        self.executor = None
+        # Futures of the decompressed copies of storage files, by index (FILE mode)
+        self.decompressed = {}
+        if self.compression and self.compression_mode == 'FILE':
+            self.tmp_dir = tempfile.TemporaryDirectory(dir=read.tmp_dir, prefix='.decompressed')
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=FILE_LOOKAHEAD)
+        # Last timestamp of each storage file by name, when the metadata has it
+        self.file_ends = {}
+        for entry in (self.info or {}).get('files') or []:
+            self.file_ends[os.path.basename(entry['path'])] = (entry['starting_time']['nanoseconds_since_epoch']
+                                                               + entry['duration']['nanoseconds'])
+        self.connections = {}
+        self.selected = None
+        self.start = None
+
+    # Start decompressing storage file i, unless it already is (FILE mode)
+    def decompress(self, i):
+        if i < len(self.paths) and i not in self.decompressed:
+            self.decompressed[i] = self.executor.submit(decompress_file, self.paths[i], self.tmp_dir.name)
+
+    # Connection and topics table (topic id -> (name, type)) of storage file i,
+    # waiting for its decompression if needed
+    def connect(self, i):
+        if i not in self.connections:
+            path = self.paths[i]
+            if self.executor is not None:
+                for ahead in range(i, i + FILE_LOOKAHEAD):
+                    self.decompress(ahead)
+                path = self.decompressed[i].result()
+            # The pipelined read loop reads from its own thread
+            # A file: URI opens read-only; as_uri percent-encodes '#', '?' and '%' in the path
+            uri = pathlib.Path(path).absolute().as_uri() + '?mode=ro'
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            topics = {topic_id: (name, msg_type) for topic_id, name, msg_type
+                      in connection.execute('SELECT id, name, type FROM topics')}
+            self.connections[i] = (connection, topics)
+        return self.connections[i]
+
+    def topic_types(self):
+        if self.info is not None and self.info.get('topics_with_message_count'):
+            return {entry['topic_metadata']['name']: entry['topic_metadata']['type']
+                    for entry in self.info['topics_with_message_count']}
+        return {name: msg_type for i in range(len(self.paths))
+                for name, msg_type in self.connect(i)[1].values()}
+
+    def message_counts(self):
+        if self.info is not None and self.info.get('topics_with_message_count'):
+            return {entry['topic_metadata']['name']: entry['message_count']
+                    for entry in self.info['topics_with_message_count']}
+        counts = collections.Counter()
+        for i in range(len(self.paths)):
+            connection, topics = self.connect(i)
+            for topic_id, count in connection.execute('SELECT topic_id, COUNT(*) FROM messages GROUP BY topic_id'):
+                counts[topics[topic_id][0]] += count
+        return dict(counts)
+
+    # First and last timestamps, from the metadata or else the timestamp index
+    def time_range(self):
+        if self.info is not None and 'starting_time' in self.info and 'duration' in self.info:
+            start = self.info['starting_time']['nanoseconds_since_epoch']
+            return start, start + self.info['duration']['nanoseconds']
+        ranges = [self.connect(i)[0].execute('SELECT MIN(timestamp), MAX(timestamp) FROM messages').fetchone()
+                  for i in range(len(self.paths))]
+        ranges = [r for r in ranges if r[0] is not None]
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+    def start_ns(self):
+        return self.time_range()[0]
+
+    def end_ns(self):
+        return self.time_range()[1]
+
+    def set_topics(self, topics):
+        self.selected = set(topics)
+
+    def seek(self, t):
+        self.start = t
+
+    # Close storage file i and delete its decompressed copy, if any
+    def release(self, i):
+        if i in self.connections:
+            self.connections.pop(i)[0].close()
+        if i in self.decompressed:
+            os.remove(self.decompressed.pop(i).result())
+
+    # Close the storage files and delete the decompressed copies, waiting for
+    # the decompressions under way
+    def close(self):
+        for i in list(self.connections):
+            self.connections.pop(i)[0].close()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.decompressed.clear()
+            self.tmp_dir.cleanup()
+
+    def read_raw_batches(self, batch_size):
+        for i in range(len(self.paths)):
+            end = self.file_ends.get(os.path.basename(self.paths[i]))
+            if self.start is not None and end is not None and end < self.start:
+                continue
+            connection, topics = self.connect(i)
+            query = 'SELECT topic_id, timestamp, data FROM messages'
+            conditions, parameters = [], []
+            if self.selected is not None:
+                topic_ids = [topic_id for topic_id, (name, msg_type) in topics.items() if name in self.selected]
+                conditions.append(f"topic_id IN ({', '.join('?' * len(topic_ids))})")
+                parameters += topic_ids
+            if self.start is not None:
+                conditions.append('timestamp >= ?')
+                parameters.append(self.start)
+            if conditions:
+                query += ' WHERE ' + ' AND '.join(conditions)
+            cursor = connection.execute(query + ' ORDER BY timestamp, id', parameters)
+            names = {topic_id: name for topic_id, (name, msg_type) in topics.items()}
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [(names[topic_id], data, t) for topic_id, t, data in rows]
+            if self.executor is not None:
+                self.release(i)
+
+    def read_batches(self, batch_size=4096):
+        if self.compression_mode != 'MESSAGE':
+            yield from self.read_raw_batches(batch_size)
+            return
+
+        # Keep a bounded number of smaller batches decompressing ahead of the consumer
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            ahead = collections.deque()
+            for batch in self.read_raw_batches(min(batch_size, 4096)):
+                ahead.append(executor.submit(decompress_batch, batch))
+                if len(ahead) > 2 * self.threads:
+                    yield ahead.popleft().result()
+            while ahead:
+                yield ahead.popleft().result()
+
+READERS = {'rosbag2': Rosbag2Reader, 'sqlite': SqliteBagReader}
+
+# Open a bag with the configured reader backend
+def open_reader(bagfile, read, files=None):
+    return READERS[read.backend](bagfile, read, files)
+
+# Split topics into at most `jobs` groups with roughly equal message counts
+def group_topics(topics, message_counts, jobs):
+    groups = [[] for _ in range(jobs)]
+    loads = [0] * jobs
+    for topic in sorted(topics, key=lambda topic: message_counts.get(topic, 0), reverse=True):
+        i = loads.index(min(loads))
+        groups[i].append(topic)
+        loads[i] += message_counts.get(topic, 0)
+    return [group for group in groups if group]
+
+# Decode one serialized message of a topic into its output row
+def message_row(plan, topic, data, t):
+    # Fixed-layout types are decoded straight from the CDR bytes; rclpy handles the rest
+    decoded = plan.decode(data) if plan.decode is not None else None
+    if decoded is None:
+        msg = plan.deserialize(data, plan.msg_class)
         stamp = msg.header.stamp.sec + msg.header.stamp.nanosec * 1e-9
-        fields = extract_fields(msg)
-        writers[topic][1].writerow([stamp, topic] + [fields[key] for key in sorted(fields)])
+        row = plan.flatten(msg)
+    else:
+        stamp, row = decoded
+    if plan.receive_time:
+        return [t, stamp, topic] + row
+    return [stamp, topic] + row
+
+# Decode a block of serialized messages of one topic together into output rows
+def batch_rows(plan, topic, payloads, times):
+    decoded = plan.decode_batch(payloads)
+    if decoded is None:
+        return [message_row(plan, topic, data, t) for data, t in zip(payloads, times)]
+    stamps, columns = decoded
+    if plan.receive_time:
+        return zip(times, stamps, itertools.repeat(topic), *columns)
+    return zip(stamps, itertools.repeat(topic), *columns)
+
+# Yield the reader's batches, stopping after the last message at or before end_ns
+def window_batches(reader, end_ns, batch_size):
+    for batch in reader.read_batches(batch_size):
+        if end_ns is not None and batch[-1][2] > end_ns:
+            batch = [message for message in batch if message[2] <= end_ns]
+            if batch:
+                yield batch
+            return
+        yield batch
+
+# Decode messages of one topic into a list of output rows, as a block if the
+# topic has a block decoder
+def topic_rows(plan, topic, payloads, times):
+    if plan.decode_batch is not None:
+        return list(batch_rows(plan, topic, payloads, times))
+    return [message_row(plan, topic, data, t) for data, t in zip(payloads, times)]
+
+# Decode (topic, payloads, receive times) blocks into (topic, rows) pairs
+def decode_blocks(plans, blocks):
+    return [(topic, topic_rows(plans[topic], topic, payloads, times)) for topic, payloads, times in blocks]
+
+# Run the read loop as a pipeline: a reader thread collects the messages of
+# `batches` into per-topic blocks of read.batch_size, as the serial loop does,
+# and feeds them to a pool of decode threads, and this thread writes the
+# decoded rows. Decode results are queued in submission order, so every topic
+# keeps its message order, and the bounded queue caps how many blocks are in
+# memory at once. Decoding and CSV formatting hold the GIL, so this overlaps
+# storage reads, decompression and file writes with the Python work rather
+# than spreading that work over cores.
+def convert_pipelined(batches, plans, read):
+    results = queue.Queue(maxsize=read.queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read_stage(executor):
+        pending = {topic: ([], []) for topic in plans}
+        try:
+            for batch in batches:
+                if stop.is_set():
+                    break
+                for topic, data, t in batch:
+                    payloads, times = pending[topic]
+                    payloads.append(data)
+                    times.append(t)
+                # Topics without a block decoder are decoded a read batch at a time
+                blocks = [(topic, *pending[topic]) for topic, plan in plans.items()
+                          if pending[topic][0] and (plan.decode_batch is None
+                                                    or len(pending[topic][0]) >= read.batch_size)]
+                for topic, payloads, times in blocks:
+                    pending[topic] = ([], [])
+                if blocks:
+                    put(executor.submit(decode_blocks, plans, blocks))
+            blocks = [(topic, payloads, times) for topic, (payloads, times) in pending.items() if payloads]
+            if blocks and not stop.is_set():
+                put(executor.submit(decode_blocks, plans, blocks))
+        except BaseException as e:
+            failed = concurrent.futures.Future()
+            failed.set_exception(e)
+            put(failed)
+        finally:
+            put(None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=read.decode_workers) as executor:
+        reader_thread = threading.Thread(target=read_stage, args=(executor,), daemon=True)
+        reader_thread.start()
+        try:
+            while True:
+                future = results.get()
+                if future is None:
+                    break
+                for topic, rows in future.result():
+                    plans[topic].writer.writerows(rows)
+        finally:
+            stop.set()
+            reader_thread.join()
+
+# How far a serial conversion got, saved every `interval` seconds (only at the
+# end if 0) so that it can be resumed: the receive time of the last message read, how
+# many messages with that receive time were read, and per topic the size of
+# its output file and the receive time of its last message. The fingerprint
+# (see checkpoint_fingerprint) records what the outputs were written from, so
+# that a checkpoint is only resumed by the same conversion.
+class Checkpoint:
+    def __init__(self, path, interval, fingerprint):
+        self.path = path
+        self.interval = interval
+        self.fingerprint = fingerprint
+        self.time = None
+        self.skip = 0
+        self.topics = {}
+        self.saved = time.monotonic()
+
+    # The checkpoint saved at `path`, or a new one if there is none. Raises
+    # ValueError if it was saved by a conversion of another bag or with other
+    # options, whose outputs cannot be appended to.
+    @classmethod
+    def load(cls, path, interval, fingerprint):
+        checkpoint = cls(path, interval, fingerprint)
+        if os.path.exists(path):
+            with open(path) as file:
+                state = json.load(file)
+            mismatch = fingerprint_mismatch(state.get('fingerprint'), fingerprint)
+            if mismatch:
+                raise ValueError(f'Cannot resume from {path}: {mismatch}; convert without --resume to start over')
+            checkpoint.time, checkpoint.skip, checkpoint.topics = state['time'], state['skip'], state['topics']
+        return checkpoint
+
+    def due(self):
+        return self.interval > 0 and time.monotonic() - self.saved >= self.interval
+
+    # Move past a batch of messages that has been read
+    def advance(self, batch):
+        t = batch[-1][2]
+        ties = 0
+        for message in reversed(batch):
+            if message[2] != t:
+                break
+            ties += 1
+        if ties == len(batch) and t == self.time:
+            self.skip += ties
+        else:
+            self.time, self.skip = t, ties
+
+    # Save the checkpoint once everything read so far is in the files
+    def save(self, plans, last_times):
+        for topic, plan in plans.items():
+            previous = self.topics.get(topic, {}).get('time')
+            self.topics[topic] = {'offset': plan.writer.sync(), 'time': last_times.get(topic, previous)}
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump({'fingerprint': self.fingerprint, 'time': self.time, 'skip': self.skip, 'topics': self.topics},
+                      file, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+        self.saved = time.monotonic()
+
+# What the outputs of a checkpointed conversion depend on: the bag (its start
+# time and storage files), the time window, and the type and columns of every
+# selected topic
+def checkpoint_fingerprint(bagfile, reader, topic_types, output, start_ns, end_ns):
+    topics = {topic: {'type': msg_type,
+                      'columns': get_flattener(get_message(resolve_type(msg_type)), output.expand_arrays)[0]}
+              for topic, msg_type in topic_types.items()}
+    files = [[os.path.basename(path), os.path.getsize(path)] for path in storage_files(bagfile)]
+    return {'bag_start': reader.start_ns(), 'files': files, 'start': start_ns, 'end': end_ns, 'topics': topics}
+
+# Why a checkpoint saved with fingerprint `saved` cannot be resumed by a
+# conversion with fingerprint `current`, or None if it can. The bag may have
+# grown since: its earlier storage files may have grown or been followed by new ones.
+def fingerprint_mismatch(saved, current):
+    if saved is None:
+        return 'it has no fingerprint'
+    if saved['bag_start'] != current['bag_start'] or len(saved['files']) > len(current['files']):
+        return 'it is of another bag'
+    for (name, size), (current_name, current_size) in zip(saved['files'], current['files']):
+        if name != current_name or size > current_size:
+            return 'it is of another bag'
+    if (saved['start'], saved['end']) != (current['start'], current['end']):
+        return 'the time window differs'
+    if saved['topics'].keys() != current['topics'].keys():
+        return 'the selected topics differ'
+    if saved['topics'] != current['topics']:
+        return 'the message types or columns differ'
+    return None
+
+# Drop the first `skip` messages received at `start` (messages a resumed
+# conversion already wrote); reading starts at `start`
+def skip_batches(batches, start, skip):
+    for batch in batches:
+        if skip:
+            n = 0
+            while n < len(batch) and n < skip and batch[n][2] == start:
+                n += 1
+            skip = skip - n if n == len(batch) else 0
+            batch = batch[n:]
+            if not batch:
+                continue
+        yield batch
+
+# Write out the block-decodable messages still waiting for a full block
+def flush_pending(plans, pending):
+    for topic, (payloads, times) in pending.items():
+        if payloads:
+            plans[topic].writer.writerows(batch_rows(plans[topic], topic, payloads, times))
+            pending[topic] = ([], [])
+
+# Write the messages of `topic_types` between start_ns and end_ns (inclusive).
+# With a checkpoint, progress is saved as it goes and a conversion that was
+# checkpointed before is continued where it stopped. With stats, the time of
+# every stage is recorded.
+def convert_reader(reader, topic_types, output_dir, bag_name, output, read, start_ns=None, end_ns=None,
+                   checkpoint=None, stats=None):
+    skip = 0
+    if checkpoint is not None and checkpoint.time is not None and (start_ns is None or start_ns <= checkpoint.time):
+        start_ns, skip = checkpoint.time, checkpoint.skip
+
+    # Jump straight to the start of the window instead of scanning up to it
+    if start_ns is not None:
+        reader.seek(start_ns)
+
+    # Create a plan (message class, flattener, writer) for each topic
+    plans = {}
+    for topic, msg_type in topic_types.items():
+        offset = checkpoint.topics.get(topic, {}).get('offset') if checkpoint is not None else None
+        plans[topic] = open_topic(topic, msg_type, output_dir, bag_name, output, read, offset)
+
+    batches = window_batches(reader, end_ns, read.read_size)
+    if stats is not None:
+        plans = instrument(plans, stats)
+        batches = timed_batches(batches, stats)
+
+    if plans and read.decode_workers > 0:
+        convert_pipelined(batches, plans, read)
+    elif plans:
+        # Payloads (and receive times) of block-decodable topics wait here until a
+        # full block is collected
+        pending = {topic: ([], []) for topic, plan in plans.items() if plan.decode_batch is not None}
+        last_times = {}
+
+        for batch in skip_batches(batches, start_ns, skip):
+            for topic, data, t in batch:
+                plan = plans[topic]
+                last_times[topic] = t
+                if plan.decode_batch is None:
+                    plan.writer.writerow(message_row(plan, topic, data, t))
+                    continue
+                payloads, times = pending[topic]
+                payloads.append(data)
+                times.append(t)
+                if len(payloads) >= read.batch_size:
+                    plan.writer.writerows(batch_rows(plan, topic, payloads, times))
+                    pending[topic] = ([], [])
+            if checkpoint is not None:
+                checkpoint.advance(batch)
+                if checkpoint.due():
+                    flush_pending(plans, pending)
+                    checkpoint.save(plans, last_times)
+
+        flush_pending(plans, pending)
+        if checkpoint is not None:
+            checkpoint.save(plans, last_times)
 
     # Close all the files
-    for file, writer in writers.values():
-        file.close()
+    for plan in plans.values():
+        plan.writer.close()
+
+# Worker entry point: convert a subset of topics with a reader of its own;
+# returns the stats it recorded (the workers' copy of `stats`)
+def convert_worker(bagfile, output_dir, bag_name, topic_types, output, read, start_ns=None, end_ns=None,
+                   files=None, stats=None):
+    reader = open_reader(bagfile, read, files)
+    try:
+        reader.set_topics(topic_types)
+        convert_reader(reader, topic_types, output_dir, bag_name, output, read, start_ns, end_ns, stats=stats)
+    finally:
+        reader.close()
+    return stats
+
+# Decode the messages of `batches` in per-topic blocks of read.batch_size, as
+# the serial loop does, and yield lists of (topic, row) in message order.
+# Messages wait until the block of their topic is decoded; so that a slow topic
+# cannot hold back the others without bound, the block of the oldest waiting
+# message is decoded early once twice read.batch_size messages are waiting.
+def ordered_rows(batches, plans, read):
+    sizes = {topic: read.batch_size if plan.decode_batch is not None else 1 for topic, plan in plans.items()}
+    limit = 2 * max(read.batch_size, 1)
+    # Topics of the waiting messages in message order, their undecoded payloads
+    # and receive times, and their decoded rows
+    waiting = collections.deque()
+    pending = {topic: ([], []) for topic in plans}
+    decoded = {topic: collections.deque() for topic in plans}
+
+    def decode(topic):
+        payloads, times = pending[topic]
+        decoded[topic].extend(topic_rows(plans[topic], topic, payloads, times))
+        pending[topic] = ([], [])
+
+    def ready(flush=False):
+        rows = []
+        while waiting:
+            topic = waiting[0]
+            if not decoded[topic]:
+                if not flush and len(waiting) < limit:
+                    break
+                decode(topic)
+            waiting.popleft()
+            rows.append((topic, decoded[topic].popleft()))
+        return rows
+
+    for batch in batches:
+        for topic, data, t in batch:
+            waiting.append(topic)
+            payloads, times = pending[topic]
+            payloads.append(data)
+            times.append(t)
+            if len(payloads) >= sizes[topic]:
+                decode(topic)
+        rows = ready()
+        if rows:
+            yield rows
+    rows = ready(flush=True)
+    if rows:
+        yield rows
+
+# Write the messages of `topic_types` between start_ns and end_ns (inclusive) to
+# a text stream as one CSV, in receive order. The columns are the union of the
+# topics' columns, left empty where a topic has no such field.
+def stream_reader(reader, topic_types, stream, output, read, start_ns=None, end_ns=None):
+    if start_ns is not None:
+        reader.seek(start_ns)
+    plans = {topic: topic_plan(topic, msg_type, output, read) for topic, msg_type in topic_types.items()}
+    columns = list(dict.fromkeys(column for plan in plans.values() for column in plan.columns))
+    index = {column: i for i, column in enumerate(["stamp", "topic"] + columns)}
+
+    # Where each topic's row values go in the merged row (None if they line up)
+    positions = {}
+    for topic, plan in plans.items():
+        topic_positions = [index[column] for column in ["stamp", "topic"] + plan.columns]
+        positions[topic] = None if topic_positions == list(range(len(index))) else topic_positions
+
+    writer = CsvTopicWriter(None, list(index), None, output, file=stream)
+    for decoded in ordered_rows(window_batches(reader, end_ns, read.read_size), plans, read):
+        rows = []
+        for topic, row in decoded:
+            if positions[topic] is not None:
+                merged = [None] * len(index)
+                for position, value in zip(positions[topic], row):
+                    merged[position] = value
+                row = merged
+            rows.append(row)
+        writer.writerows(rows)
+    writer.close()
+
+# Split [start_ns, end_ns] into `shards` consecutive, non-overlapping windows. The
+# first and last windows stay open-ended when no bound was given.
+def time_shards(reader, start_ns, end_ns, shards):
+    first = reader.start_ns() if start_ns is None else start_ns
+    last = reader.end_ns() if end_ns is None else end_ns
+    bounds = [first + (last - first) * i // shards for i in range(shards + 1)]
+    windows = [(bounds[i], bounds[i + 1] - 1) for i in range(shards)]
+    windows[0] = (start_ns, windows[0][1])
+    windows[-1] = (windows[-1][0], end_ns)
+    return windows
+
+# Append each shard's output (minus its header) to the final output, in shard
+# order; CSV shards are written uncompressed and compressed here
+def concatenate_shards(shard_dirs, output_dir, output):
+    for name in os.listdir(shard_dirs[0]):
+        if name.endswith('.meta.json'):
+            shutil.copyfile(os.path.join(shard_dirs[0], name), os.path.join(output_dir, name))
+            continue
+        if name.endswith('.parquet'):
+            concatenate_parquet([os.path.join(shard_dir, name) for shard_dir in shard_dirs],
+                                os.path.join(output_dir, name), output)
+            continue
+        with open_csv_file(output_path(os.path.join(output_dir, name[:-len('.csv')]), output), output) as merged:
+            for i, shard_dir in enumerate(shard_dirs):
+                with open(os.path.join(shard_dir, name), newline='') as shard:
+                    if i > 0:
+                        shard.readline()
+                    shutil.copyfileobj(shard, merged)
+
+# Merge the per-file outputs of a split bag into one output per topic with a
+# streaming k-way merge on the leading receive_time column, which is dropped.
+# The parts are written uncompressed and the merged outputs compressed here.
+def merge_split_outputs(part_dirs, output_dir, output):
+    for name in os.listdir(part_dirs[0]):
+        if name.endswith('.meta.json'):
+            shutil.copyfile(os.path.join(part_dirs[0], name), os.path.join(output_dir, name))
+            continue
+        parts = [open(os.path.join(part_dir, name), newline='') for part_dir in part_dirs]
+        readers = [csv.reader(part) for part in parts]
+        header = [next(reader) for reader in readers][0]
+        with open_csv_file(output_path(os.path.join(output_dir, name[:-len('.csv')]), output), output) as merged:
+            writer = csv.writer(merged)
+            writer.writerow(header[1:])
+            for row in heapq.merge(*readers, key=lambda row: int(row[0])):
+                writer.writerow(row[1:])
+        for part in parts:
+            part.close()
+
+# Wait for the convert_worker futures, adding the stats they return to `stats`
+def merge_stats(stats, futures):
+    for future in futures:
+        worker_stats = future.result()
+        if stats is not None:
+            stats.merge(worker_stats)
+
+# Names of the files a conversion writes for `topics` of a bag (without the checkpoint)
+def output_names(bag_name, topics, output):
+    names = []
+    for topic in topics:
+        base = bag_name + topic.replace('/', '_')
+        names += [os.path.basename(output_path(base, output)), base + '.meta.json']
+    return names
+
+# Convert a bag; returns the names of the files written in output_dir
+def bag_to_csv(bagfile, output_dir, topics=None, exclude_topics=None, start=None, end=None, jobs=1, shards=1,
+               output_format='csv', compression='snappy', expand_arrays=None, fast_decode=True,
+               batch_size=4096, backend='rosbag2', parallel_splits=False, decompress_threads=None,
+               decode_workers=0, queue_size=8, buffer_size=1 << 20, flush_rows=4096, flush_bytes=1 << 20,
+               compress=None, compress_level=None, resume=False, checkpoint_interval=None, stats=None,
+               read_size=1024, tmp_dir=None):
+    if compress and output_format != 'csv':
+        raise ValueError('Stream compression only applies to CSV output; use compression for Parquet')
+    # Checkpoints cover serial conversions to uncompressed CSV
+    serial = (output_format == 'csv' and not compress and shards <= 1 and not parallel_splits and jobs <= 1
+              and decode_workers == 0)
+    # Checkpoints are saved when asked for, or to go on resuming a conversion
+    checkpointed = resume or checkpoint_interval is not None
+    if checkpointed and not serial:
+        raise ValueError('Checkpoints and resuming need a serial conversion (no jobs, shards, parallel splits or '
+                         'pipeline) to uncompressed CSV')
+    # Arrays are expanded into columns for CSV and kept as list columns for Parquet by default
+    if expand_arrays is None:
+        expand_arrays = output_format == 'csv'
+    output = OutputOptions(output_format, compression, expand_arrays, buffer_size=buffer_size,
+                           flush_rows=flush_rows, flush_bytes=flush_bytes, compress=compress,
+                           compress_level=compress_level)
+    # Decompressed storage files go beside the outputs rather than to a possibly small /tmp
+    read = ReadOptions(fast_decode, batch_size, backend, decompress_threads, decode_workers, queue_size, read_size,
+                       output_dir if tmp_dir is None else tmp_dir)
+    reader = open_reader(bagfile, read)
+    try:
+        # Create a dictionary mapping topic names to types
+        topic_types = reader.topic_types()
+        selected = select_topics(topic_types, topics, exclude_topics)
+        if not selected:
+            raise ValueError(f'No topic of {bagfile} matches the topic selection')
+        bag_name = os.path.basename(os.path.normpath(bagfile))
+        start_ns = resolve_time(start, reader)
+        end_ns = resolve_time(end, reader)
+        names = output_names(bag_name, selected, output)
+
+        # Convert consecutive time windows in worker processes and stitch them together
+        if shards > 1:
+            windows = time_shards(reader, start_ns, end_ns, shards)
+            with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+                shard_dirs = [os.path.join(tmp_dir, str(i)) for i in range(len(windows))]
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs if jobs > 1 else shards) as executor:
+                    futures = []
+                    for shard_dir, (shard_start, shard_end) in zip(shard_dirs, windows):
+                        os.makedirs(shard_dir)
+                        futures.append(executor.submit(convert_worker, bagfile, shard_dir, bag_name,
+                                                       selected, output._replace(compress=None), read,
+                                                       shard_start, shard_end, stats=stats))
+                    merge_stats(stats, futures)
+                concatenate_shards(shard_dirs, output_dir, output)
+            return names
+
+        # Read each file of a split bag in its own worker and merge the results by receive time
+        # (rosbag2 can only read a compressed bag as a whole)
+        paths = []
+        if parallel_splits and not (backend == 'rosbag2' and bag_compression(bagfile)[0] is not None):
+            paths = storage_files(bagfile)
+        if len(paths) > 1:
+            if output_format != 'csv':
+                raise ValueError('Parallel reading of split bags only supports CSV output')
+            part_output = output._replace(receive_time=True, compress=None)
+            with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+                part_dirs = [os.path.join(tmp_dir, str(i)) for i in range(len(paths))]
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs if jobs > 1 else len(paths)) as executor:
+                    futures = []
+                    for part_dir, path in zip(part_dirs, paths):
+                        os.makedirs(part_dir)
+                        futures.append(executor.submit(convert_worker, bagfile, part_dir, bag_name,
+                                                       selected, part_output, read, start_ns, end_ns, [path],
+                                                       stats))
+                    merge_stats(stats, futures)
+                merge_split_outputs(part_dirs, output_dir, output)
+            return names
+
+        # Hand groups of topics to worker processes, each with its own reader and files
+        if jobs > 1 and len(selected) > 1:
+            groups = group_topics(selected, reader.message_counts(), jobs)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=len(groups)) as executor:
+                futures = [executor.submit(convert_worker, bagfile, output_dir, bag_name,
+                                           {topic: selected[topic] for topic in group}, output, read, start_ns, end_ns,
+                                           stats=stats)
+                           for group in groups]
+                merge_stats(stats, futures)
+            return names
+
+        # Only fetch the selected topics from storage; an empty filter would read everything
+        if len(selected) < len(topic_types):
+            reader.set_topics(selected)
+
+        checkpoint = None
+        if checkpointed:
+            checkpoint_path = os.path.join(output_dir, bag_name + '.checkpoint.json')
+            fingerprint = checkpoint_fingerprint(bagfile, reader, selected, output, start_ns, end_ns)
+            interval = 60 if checkpoint_interval is None else checkpoint_interval
+            checkpoint = (Checkpoint.load(checkpoint_path, interval, fingerprint) if resume
+                          else Checkpoint(checkpoint_path, interval, fingerprint))
+        convert_reader(reader, selected, output_dir, bag_name, output, read, start_ns, end_ns, checkpoint, stats)
+        if checkpoint is not None:
+            names.append(os.path.basename(checkpoint.path))
+        return names
+    finally:
+        reader.close()
+
+# Stream the selected topics of a bag to stdout as CSV, for shell pipelines
+def bag_to_stdout(bagfile, topics=None, exclude_topics=None, start=None, end=None, expand_arrays=True,
+                  fast_decode=True, batch_size=4096, backend='rosbag2', decompress_threads=None,
+                  buffer_size=1 << 20, flush_rows=4096, flush_bytes=1 << 20, read_size=1024, tmp_dir=None):
+    output = OutputOptions('csv', expand_arrays=expand_arrays, buffer_size=buffer_size, flush_rows=flush_rows,
+                           flush_bytes=flush_bytes)
+    read = ReadOptions(fast_decode, batch_size, backend, decompress_threads, read_size=read_size, tmp_dir=tmp_dir)
+    reader = open_reader(bagfile, read)
+    try:
+        topic_types = reader.topic_types()
+        selected = select_topics(topic_types, topics, exclude_topics)
+        if not selected:
+            raise ValueError(f'No topic of {bagfile} matches the topic selection')
+        if len(selected) < len(topic_types):
+            reader.set_topics(selected)
+        # A buffered stream of its own over the stdout file descriptor, which stays open when it is closed
+        stream = open(sys.stdout.fileno(), 'w', newline='', buffering=buffer_size, closefd=False)
+        stream_reader(reader, selected, stream, output, read, resolve_time(start, reader),
+                      resolve_time(end, reader))
+    finally:
+        reader.close()
+
+# Options of bag_to_csv that change its output, and so are part of the cache key
+CACHED_OPTIONS = ['topics', 'exclude_topics', 'start', 'end', 'output_format', 'compression', 'expand_arrays',
+                  'compress', 'compress_level']
+
+# bag_to_csv, skipped when the outputs of the same bag files, converter and
+# options are in the cache at cache_dir (no caching if None); `force` converts
+# anyway. The cache is trimmed to cache_size bytes; outputs larger than that are
+# not stored. Returns True on a cache hit.
+def cached_bag_to_csv(bagfile, output_dir, cache_dir=None, cache_size=10 << 30, force=False, **options):
+    if cache_dir is None:
+        bag_to_csv(bagfile, output_dir, **options)
+        return False
+    bag_name = os.path.basename(os.path.normpath(bagfile))
+    paths = storage_files(bagfile)
+    if read_bag_info(bagfile) is not None:
+        paths.append(os.path.join(bagfile, 'metadata.yaml'))
+    key = cache.cache_key(paths, bag_name, {name: options.get(name) for name in CACHED_OPTIONS})
+    if not force and cache.restore(cache_dir, key, output_dir):
+        return True
+
+    names = bag_to_csv(bagfile, output_dir, **options)
+    if sum(os.path.getsize(os.path.join(output_dir, name)) for name in names) <= cache_size:
+        cache.store(cache_dir, key, output_dir, names)
+        cache.evict(cache_dir, cache_size)
+    return False
+
+# Find the bags under a path: anything but a directory without metadata.yaml is
+# taken as a bag, such directories are searched recursively
+def find_bags(path):
+    if not os.path.isdir(path) or os.path.exists(os.path.join(path, 'metadata.yaml')):
+        return [path]
+    bags = []
+    for root, dirs, files in os.walk(path):
+        if 'metadata.yaml' in files:
+            bags.append(root)
+            dirs[:] = []
+    return sorted(bags)
+
+# Batch worker entry point; returns the error message, or None on success
+def batch_worker(bagfile, output_dir, options):
+    try:
+        cached_bag_to_csv(bagfile, output_dir, **options)
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+    return None
+
+# Convert every bag found under `paths` in a pool of `workers` processes, so the
+# rclpy/rosbag2 imports are paid once per worker rather than once per bag.
+# Outputs are named after the bag's base name, so bags sharing one (e.g.
+# day1/rosbag and day2/rosbag) would overwrite each other; they fail instead.
+# Returns {bagfile: error message or None}.
+def batch_bag_to_csv(paths, output_dir, workers=None, **options):
+    # The same bag may be given as bag, bag/ or ./bag; keep its first spelling
+    unique = {}
+    for bag in (bag for path in paths for bag in find_bags(path)):
+        unique.setdefault(os.path.realpath(bag), bag)
+    bags = list(unique.values())
+    by_name = collections.defaultdict(list)
+    for bag in bags:
+        by_name[os.path.basename(os.path.normpath(bag))].append(bag)
+    results = {}
+    for name, named in by_name.items():
+        if len(named) > 1:
+            for bag in named:
+                results[bag] = f"Bag name '{name}' is shared by {', '.join(named)}; their outputs would clash"
+                print(f'FAILED: {bag}', flush=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(batch_worker, bag, output_dir, options): bag for bag in bags if bag not in results}
+        for future in concurrent.futures.as_completed(futures):
+            bag = futures[future]
+            results[bag] = future.result()
+            print(f"{'FAILED' if results[bag] else 'OK'}: {bag}", flush=True)
+
+    failed = [bag for bag in bags if results[bag]]
+    print(f'Converted {len(bags) - len(failed)}/{len(bags)} bags.')
+    for bag in failed:
+        print(f'  {bag}: {results[bag]}')
+    return {bag: results[bag] for bag in bags}
 
 def main():
     parser = argparse.ArgumentParser(description='Convert a ROS bag file to CSV.')
-    parser.add_argument('bagfile', help='The path to the input bag file.')
-    parser.add_argument('output_dir', help='The directory to write the output CSV files to.')
+    parser.add_argument('bagfile', nargs='+',
+                        help='The path to the input bag file (several bags or parent directories with --batch).')
+    parser.add_argument('output_dir', nargs='?',
+                        help='The directory to write the output CSV files to (omitted with --stdout).')
+    parser.add_argument('--stdout', action='store_true',
+                        help='Write the selected topics to stdout as one CSV, in receive order.')
+    parser.add_argument('--topics', '--topic', nargs='+', metavar='PATTERN',
+                        help="Only convert topics matching these globs ('re:' prefix for a regex).")
+    parser.add_argument('--exclude-topics', nargs='+', metavar='PATTERN',
+                        help="Skip topics matching these globs ('re:' prefix for a regex).")
+    parser.add_argument('--start', type=time_bound,
+                        help="Start time in epoch seconds, or '+SECONDS' from the bag start.")
+    parser.add_argument('--end', type=time_bound,
+                        help="End time in epoch seconds, or '+SECONDS' from the bag start.")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of worker processes to split the topics across.')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the time range into this many shards converted in parallel.')
+    parser.add_argument('--batch', action='store_true',
+                        help='Convert every bag found under the given paths.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of bags converted concurrently in batch mode.')
+    parser.add_argument('--format', dest='output_format', choices=['csv', 'parquet'], default='csv',
+                        help='Output file format.')
+    parser.add_argument('--compression', default='snappy',
+                        choices=['none', 'snappy', 'gzip', 'brotli', 'lz4', 'zstd'],
+                        help='Parquet compression codec.')
+    parser.add_argument('--expand-arrays', action=argparse.BooleanOptionalAction,
+                        help='Write fixed-size numeric arrays as one column per element '
+                             '(default: on for CSV, off for Parquet).')
+    parser.add_argument('--fast-decode', action=argparse.BooleanOptionalAction, default=True,
+                        help='Decode fixed-layout message types directly from CDR instead of through rclpy.')
+    parser.add_argument('--batch-size', type=int, default=4096,
+                        help='Messages per topic decoded together into NumPy arrays (1 to disable); with --stdout, '
+                             'up to twice this many messages wait for their blocks to be decoded.')
+    parser.add_argument('--reader', dest='backend', choices=['rosbag2', 'sqlite'], default='rosbag2',
+                        help='Read through rosbag2_py, or read sqlite3 .db3 files directly.')
+    parser.add_argument('--parallel-splits', action='store_true',
+                        help='Read each file of a split bag in its own worker process.')
+    parser.add_argument('--decompress-threads', type=int,
+                        help='Threads decompressing message-compressed bags with --reader sqlite (default: one per '
+                             'CPU); file-compressed bags decompress the file being read and the next.')
+    parser.add_argument('--tmp-dir',
+                        help='Directory for the decompressed copies of file-compressed storage files with --reader '
+                             'sqlite (default: output_dir, or the system temp dir with --stdout).')
+    parser.add_argument('--pipeline', dest='decode_workers', type=int, default=0, metavar='WORKERS',
+                        help='Overlap storage reads and file writes with decoding, using this many decode threads. '
+                             'Decoding and formatting share one core (the GIL), so this only helps when reading '
+                             'or writing is slow; use --jobs or --shards to use more cores.')
+    parser.add_argument('--queue-size', type=int, default=8,
+                        help='Decode blocks held in flight between the pipeline stages.')
+    parser.add_argument('--read-size', type=int, default=1024,
+                        help='Messages read from storage at a time.')
+    parser.add_argument('--compress', choices=['gzip', 'zstd', 'lz4'],
+                        help='Compress the CSV files (.csv.gz, .csv.zst or .csv.lz4) on background threads.')
+    parser.add_argument('--compress-level', type=int,
+                        help='Level of the CSV compression (default: the library default).')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue from the checkpoint of an earlier conversion into output_dir, '
+                             'or append the new messages of a bag that has grown.')
+    parser.add_argument('--checkpoint-interval', type=float, metavar='SECONDS',
+                        help='Save a checkpoint of a serial CSV conversion every SECONDS, so that --resume can '
+                             'continue it (0 to only checkpoint at the end; default with --resume: 60).')
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep a copy of the outputs in a cache, and skip bags converted before with the same '
+                             'options by restoring them from it.')
+    parser.add_argument('--cache-dir',
+                        help='Directory of the cache (implies --cache; default: output_dir.cache).')
+    parser.add_argument('--cache-size', type=float, default=10, metavar='GB',
+                        help='Size the cache is trimmed to, dropping the least recently used outputs.')
+    parser.add_argument('--force', action='store_true', help='Convert even if the outputs are cached.')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the time spent in each stage and the throughput of each topic.')
+    parser.add_argument('--stats-json', metavar='PATH', help='Also write the --stats report to a JSON file.')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Profile the conversion with cProfile and write the pstats file to PATH '
+                             '(worker processes are not profiled).')
+    parser.add_argument('--profile-stacks', metavar='PATH',
+                        help='Sample the stacks of all threads during the conversion and write them to PATH '
+                             'in collapsed form, for flamegraph tools.')
+    parser.add_argument('--write-buffer', dest='buffer_size', type=int, default=1 << 20, metavar='BYTES',
+                        help='Size of the write buffer of each CSV file.')
+    parser.add_argument('--flush-rows', type=int, default=4096,
+                        help='Number of CSV rows to collect per topic before formatting them.')
+    parser.add_argument('--flush-bytes', type=int, default=1 << 20,
+                        help='Amount of formatted CSV text to collect per topic before writing it to the file.')
     args = parser.parse_args()
-    
-    bag_to_csv(args.bagfile, args.output_dir)
+
+    if args.profile or args.profile_stacks:
+        with profiled(args.profile, args.profile_stacks):
+            run(parser, args)
+    else:
+        run(parser, args)
+
+# Run the conversion the command line asks for
+def run(parser, args):
+    if args.stdout:
+        if len(args.bagfile) > 1:
+            parser.error('--stdout takes a single bag and no output_dir')
+        if args.output_format != 'csv' or args.compress:
+            parser.error('--stdout only writes uncompressed CSV')
+        if args.stats or args.stats_json:
+            parser.error('--stats is not available with --stdout')
+        # Options of conversions to output_dir, which streaming would silently ignore
+        unsupported = [flag for flag, used in [
+            ('--batch', args.batch), ('--jobs', args.jobs != 1), ('--shards', args.shards != 1),
+            ('--parallel-splits', args.parallel_splits), ('--pipeline', args.decode_workers != 0),
+            ('--resume', args.resume), ('--checkpoint-interval', args.checkpoint_interval is not None),
+            ('--cache', args.cache), ('--cache-dir', args.cache_dir), ('--force', args.force)] if used]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} cannot be used with --stdout")
+        try:
+            bag_to_stdout(args.bagfile[0], topics=args.topics, exclude_topics=args.exclude_topics,
+                          start=args.start, end=args.end,
+                          expand_arrays=True if args.expand_arrays is None else args.expand_arrays,
+                          fast_decode=args.fast_decode, batch_size=args.batch_size, backend=args.backend,
+                          decompress_threads=args.decompress_threads, buffer_size=args.buffer_size,
+                          flush_rows=args.flush_rows, flush_bytes=args.flush_bytes, read_size=args.read_size,
+                          tmp_dir=args.tmp_dir)
+        except BrokenPipeError:
+            # The reader of the pipe went away. Point stdout at /dev/null so that
+            # flushing it at exit does not fail again, and exit like SIGPIPE would.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(128 + signal.SIGPIPE)
+        except ValueError as e:
+            parser.error(str(e))
+        return
+    # bagfile takes all positional arguments, the last of which is output_dir
+    if len(args.bagfile) < 2:
+        parser.error('the following arguments are required: output_dir')
+    args.output_dir = args.bagfile.pop()
+
+    options = dict(topics=args.topics, exclude_topics=args.exclude_topics,
+                   start=args.start, end=args.end, jobs=args.jobs, shards=args.shards,
+                   output_format=args.output_format, compression=args.compression,
+                   expand_arrays=args.expand_arrays, fast_decode=args.fast_decode,
+                   batch_size=args.batch_size, backend=args.backend, parallel_splits=args.parallel_splits,
+                   decompress_threads=args.decompress_threads, decode_workers=args.decode_workers,
+                   queue_size=args.queue_size, buffer_size=args.buffer_size, flush_rows=args.flush_rows,
+                   flush_bytes=args.flush_bytes, compress=args.compress, compress_level=args.compress_level,
+                   resume=args.resume, checkpoint_interval=args.checkpoint_interval, read_size=args.read_size,
+                   tmp_dir=args.tmp_dir)
+    if args.cache or args.cache_dir:
+        options.update(cache_dir=args.cache_dir or os.path.normpath(args.output_dir) + '.cache',
+                       cache_size=int(args.cache_size * (1 << 30)), force=args.force)
+    if args.batch or len(args.bagfile) > 1:
+        if args.stats or args.stats_json:
+            parser.error('--stats reports on a single bag')
+        results = batch_bag_to_csv(args.bagfile, args.output_dir, workers=args.workers, **options)
+        if any(results.values()):
+            sys.exit(1)
+    elif args.stats or args.stats_json:
+        stats = Stats()
+        if cached_bag_to_csv(args.bagfile[0], args.output_dir, stats=stats, **options):
+            print('Outputs restored from the cache, nothing was converted (use --force to convert).')
+            return
+        stats.stop()
+        stats.print_table()
+        if args.stats_json:
+            stats.write_json(args.stats_json)
+    else:
+        cached_bag_to_csv(args.bagfile[0], args.output_dir, **options)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
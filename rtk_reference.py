@@ -25,10 +25,15 @@ def translate_gps_heading_data(filename1, filename2):
     data2 = pd.read_csv(filename2)
     data = pd.merge(data2, data1, on='stamp', how='inner')
 
-    # Convert string representations of NumPy arrays to actual NumPy arrays
-    data['position_covariance'] = data['position_covariance'].apply(convert_string_to_arr)
-    data['latitude'] = data['position_covariance'].apply(extract_latitude)
-    data['longitude'] = data['position_covariance'].apply(extract_longitude)
+    if 'position_covariance.3' in data:
+        # Arrays are expanded into one numeric column per element
+        data['latitude'] = data['position_covariance.3']
+        data['longitude'] = data['position_covariance.4']
+    else:
+        # Convert string representations of NumPy arrays to actual NumPy arrays
+        data['position_covariance'] = data['position_covariance'].apply(convert_string_to_arr)
+        data['latitude'] = data['position_covariance'].apply(extract_latitude)
+        data['longitude'] = data['position_covariance'].apply(extract_longitude)
 
     utm_mcity_x, utm_mcity_y = latlon_to_utm(MCITY_LAT, MCITY_LON)
 
@@ -0,0 +1,190 @@
+import collections
+import json
+import threading
+import time
+
+# Stages of a conversion, in pipeline order
+STAGES = ['read', 'deserialize', 'extract', 'format', 'write']
+
+# Cumulative time per stage, and messages, payload bytes and processing time
+# (every stage but read) per topic. Times from several decode threads or
+# worker processes add up, so stage times can exceed the wall time.
+class Stats:
+    def __init__(self):
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.topics = collections.defaultdict(lambda: {'messages': 0, 'bytes': 0, 'seconds': 0.0})
+        self.wall = None
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    # Locks and lambdas do not pickle; worker processes send their stats back
+    def __getstate__(self):
+        return {'stages': self.stages, 'topics': dict(self.topics), 'wall': self.wall, 'started': self.started}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.stages = state['stages']
+        self.topics.update(state['topics'])
+        self.wall, self.started = state['wall'], state['started']
+
+    def add(self, stage, topic, seconds):
+        with self.lock:
+            self.stages[stage] += seconds
+            if topic is not None:
+                self.topics[topic]['seconds'] += seconds
+
+    def count(self, batch):
+        counts = collections.Counter()
+        sizes = collections.Counter()
+        for topic, data, t in batch:
+            counts[topic] += 1
+            sizes[topic] += len(data)
+        with self.lock:
+            for topic, messages in counts.items():
+                self.topics[topic]['messages'] += messages
+                self.topics[topic]['bytes'] += sizes[topic]
+
+    # Add the stats of a worker
+    def merge(self, other):
+        for stage, seconds in other.stages.items():
+            self.stages[stage] += seconds
+        for topic, record in other.topics.items():
+            for name, value in record.items():
+                self.topics[topic][name] += value
+
+    def stop(self):
+        self.wall = time.perf_counter() - self.started
+
+    def report(self):
+        if self.wall is None:
+            self.stop()
+        messages = sum(record['messages'] for record in self.topics.values())
+        total_bytes = sum(record['bytes'] for record in self.topics.values())
+        topics = {}
+        for topic, record in sorted(self.topics.items()):
+            seconds = record['seconds']
+            topics[topic] = dict(record,
+                                 messages_per_second=record['messages'] / seconds if seconds else None,
+                                 bytes_per_second=record['bytes'] / seconds if seconds else None)
+        return {
+            'wall_seconds': self.wall,
+            'messages': messages,
+            'bytes': total_bytes,
+            'messages_per_second': messages / self.wall if self.wall else None,
+            'bytes_per_second': total_bytes / self.wall if self.wall else None,
+            'stages': dict(self.stages),
+            'topics': topics,
+        }
+
+    def print_table(self, file=None):
+        report = self.report()
+        wall = report['wall_seconds']
+        print(f"{'stage':<12} {'seconds':>10} {'% of wall':>10}", file=file)
+        for stage, seconds in report['stages'].items():
+            print(f'{stage:<12} {seconds:>10.3f} {100 * seconds / wall if wall else 0:>9.1f}%', file=file)
+        print(file=file)
+        width = max([len('topic')] + [len(topic) for topic in report['topics']])
+        print(f"{'topic':<{width}} {'messages':>10} {'MB':>10} {'seconds':>10} {'msgs/s':>12} {'MB/s':>10}",
+              file=file)
+        for topic, record in report['topics'].items():
+            print(f"{topic:<{width}} {record['messages']:>10} {record['bytes'] / 1e6:>10.2f} "
+                  f"{record['seconds']:>10.3f} {record['messages_per_second'] or 0:>12.0f} "
+                  f"{(record['bytes_per_second'] or 0) / 1e6:>10.2f}", file=file)
+        print(f"{'total':<{width}} {report['messages']:>10} {report['bytes'] / 1e6:>10.2f} {wall:>10.3f} "
+              f"{report['messages_per_second'] or 0:>12.0f} {(report['bytes_per_second'] or 0) / 1e6:>10.2f}",
+              file=file)
+
+    def write_json(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+# Wrap a function so the time spent in it is added to a stage of `topic`
+def timed(function, stats, stage, topic):
+    if function is None:
+        return None
+
+    def call(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            stats.add(stage, topic, time.perf_counter() - start)
+    return call
+
+# Times the writes to an output file
+class TimedFile:
+    def __init__(self, file, stats, topic):
+        self.file = file
+        self.stats = stats
+        self.topic = topic
+        self.seconds = 0.0
+
+    def write(self, text):
+        start = time.perf_counter()
+        try:
+            return self.file.write(text)
+        finally:
+            seconds = time.perf_counter() - start
+            self.seconds += seconds
+            self.stats.add('write', self.topic, seconds)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+# Times a topic writer: writes to its file count as write, the rest (turning
+# rows into CSV text) as format. Writers without a file of their own (Parquet)
+# count as write entirely.
+class TimedWriter:
+    def __init__(self, writer, stats, topic):
+        self.writer = writer
+        self.stats = stats
+        self.topic = topic
+        self.file = None
+        if hasattr(writer, 'file'):
+            self.file = writer.file = TimedFile(writer.file, stats, topic)
+
+    def timed(self, method, *args):
+        start = time.perf_counter()
+        written = self.file.seconds if self.file is not None else 0.0
+        try:
+            return method(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            if self.file is None:
+                self.stats.add('write', self.topic, seconds)
+            else:
+                self.stats.add('format', self.topic, seconds - (self.file.seconds - written))
+
+    def writerow(self, row):
+        self.timed(self.writer.writerow, row)
+
+    def writerows(self, rows):
+        self.timed(self.writer.writerows, rows)
+
+    def sync(self):
+        return self.timed(self.writer.sync)
+
+    def close(self):
+        self.timed(self.writer.close)
+
+# Plans whose decoders, flatteners and writers record their time in `stats`
+def instrument(plans, stats):
+    return {topic: plan._replace(deserialize=timed(plan.deserialize, stats, 'deserialize', topic),
+                                 decode=timed(plan.decode, stats, 'deserialize', topic),
+                                 decode_batch=timed(plan.decode_batch, stats, 'deserialize', topic),
+                                 flatten=timed(plan.flatten, stats, 'extract', topic),
+                                 writer=TimedWriter(plan.writer, stats, topic))
+            for topic, plan in plans.items()}
+
+# Yield the batches of `batches`, timing how long each takes to read and
+# counting its messages and bytes per topic
+def timed_batches(batches, stats):
+    batches = iter(batches)
+    while True:
+        start = time.perf_counter()
+        batch = next(batches, None)
+        stats.add('read', None, time.perf_counter() - start)
+        if batch is None:
+            return
+        stats.count(batch)
+        yield batch
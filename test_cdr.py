@@ -0,0 +1,85 @@
+import random
+import numpy as np
+import pytest
+
+pytest.importorskip('rclpy')
+
+from benchmark import ENCODERS
+from ros2bag_to_csv import ReadOptions, batch_rows, message_row, topic_plan
+from writers import OutputOptions
+
+TYPES = list(ENCODERS)
+
+# Header frame ids of the encoded messages: empty, odd and even lengths, and
+# lengths that leave the fields after them at every alignment phase
+FRAME_IDS = ['', 'a', 'ab', 'abc', 'gps', 'imu_link', 'x' * 13]
+
+# The plan of a topic of `msg_type` with the CDR decoders, and the same plan
+# decoding through rclpy and the flattener
+def plans(msg_type, expand_arrays):
+    plan = topic_plan('/topic', msg_type, OutputOptions('csv', expand_arrays=expand_arrays), ReadOptions())
+    return plan, plan._replace(decode=None, decode_batch=None)
+
+# Encode one message of `msg_type` per frame id
+def encode(msg_type, frame_ids, seed=0):
+    rng = random.Random(seed)
+    return [ENCODERS[msg_type](rng, 1696274234_000_000_000 + i * 10**7 + 1, i, frame_id)
+            for i, frame_id in enumerate(frame_ids)]
+
+def assert_rows_equal(rows, expected):
+    rows = [list(row) for row in rows]
+    assert len(rows) == len(expected)
+    for row, expected_row in zip(rows, expected):
+        assert len(row) == len(expected_row)
+        for value, expected_value in zip(row, expected_row):
+            if isinstance(expected_value, np.ndarray):
+                assert isinstance(value, np.ndarray) and value.dtype == expected_value.dtype
+                assert np.array_equal(value, expected_value)
+            else:
+                assert value == expected_value
+
+@pytest.mark.parametrize('expand_arrays', [True, False])
+@pytest.mark.parametrize('msg_type', TYPES)
+def test_decoder_matches_rclpy(msg_type, expand_arrays):
+    plan, reference = plans(msg_type, expand_arrays)
+    assert plan.decode is not None
+    payloads = encode(msg_type, FRAME_IDS)
+    for data in payloads:
+        assert plan.decode(data) is not None
+    assert_rows_equal([message_row(plan, '/topic', data, i) for i, data in enumerate(payloads)],
+                      [message_row(reference, '/topic', data, i) for i, data in enumerate(payloads)])
+
+@pytest.mark.parametrize('msg_type', TYPES)
+def test_decoder_falls_back(msg_type):
+    plan, reference = plans(msg_type, True)
+    data = encode(msg_type, ['odd'])[0]
+    big_endian = data[:1] + b'\x00' + data[2:]
+    assert plan.decode(big_endian) is None
+    for size in (2, 6, 12, len(data) // 2, len(data) - 1):
+        assert plan.decode(data[:size]) is None
+
+@pytest.mark.parametrize('expand_arrays', [True, False])
+@pytest.mark.parametrize('msg_type', TYPES)
+def test_batch_decoder_matches_rclpy(msg_type, expand_arrays):
+    plan, reference = plans(msg_type, expand_arrays)
+    assert plan.decode_batch is not None
+    # Several string lengths, and so several byte layouts, mixed in one block
+    payloads = encode(msg_type, FRAME_IDS * 3, seed=1)
+    times = list(range(len(payloads)))
+    assert plan.decode_batch(payloads) is not None
+    assert_rows_equal(batch_rows(plan, '/topic', payloads, times),
+                      [message_row(reference, '/topic', data, t) for data, t in zip(payloads, times)])
+
+@pytest.mark.parametrize('msg_type', TYPES)
+def test_batch_decoder_falls_back(msg_type):
+    plan, reference = plans(msg_type, True)
+    payloads = encode(msg_type, FRAME_IDS)
+    data = payloads[-1]
+    assert plan.decode_batch(payloads + [data[:1] + b'\x00' + data[2:]]) is None
+    for size in (6, 12, len(data) // 2, len(data) - 1):
+        assert plan.decode_batch(payloads + [data[:size]]) is None
+
+    # A block that falls back is decoded message by message
+    times = list(range(len(payloads)))
+    rows = batch_rows(plan._replace(decode_batch=lambda payloads: None), '/topic', payloads, times)
+    assert_rows_equal(rows, [message_row(reference, '/topic', data, t) for data, t in zip(payloads, times)])
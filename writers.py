@@ -0,0 +1,269 @@
+import collections
+import csv
+import io
+import os
+import queue
+import re
+import threading
+import zlib
+
+# Output settings shared by every topic of a conversion; receive_time adds a
+# leading column with the bag timestamp, used for intermediate outputs.
+# buffer_size is the size of each CSV file's write buffer; CSV rows are
+# formatted flush_rows at a time and handed to the file once flush_bytes of
+# text have been collected. compress is the stream compression of CSV files
+# (None, 'gzip', 'zstd' or 'lz4') and compress_level its level (None for the
+# library default).
+OutputOptions = collections.namedtuple('OutputOptions', ['format', 'compression', 'expand_arrays', 'receive_time',
+                                                         'buffer_size', 'flush_rows', 'flush_bytes',
+                                                         'compress', 'compress_level'],
+                                       defaults=['csv', 'snappy', False, False, 1 << 20, 4096, 1 << 20, None, None])
+
+# File extension for each output format
+EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet'}
+
+# Extra file extension for each CSV stream compression
+COMPRESSED_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+
+# Each compressor returns the leading bytes of the stream and the (compress,
+# flush) functions producing the rest of it
+def gzip_compressor(level):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, 31)
+    return b'', compressor.compress, compressor.flush
+
+def zstd_compressor(level):
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstandard is required for zstd output (pip install zstandard)')
+    compressor = zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    return b'', compressor.compress, compressor.flush
+
+def lz4_compressor(level):
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ImportError('lz4 is required for lz4 output (pip install lz4)')
+    compressor = lz4.frame.LZ4FrameCompressor(compression_level=0 if level is None else level)
+    return compressor.begin(), compressor.compress, compressor.flush
+
+COMPRESSORS = {'gzip': gzip_compressor, 'zstd': zstd_compressor, 'lz4': lz4_compressor}
+
+# A write-only text file that is compressed on a background thread, so the
+# compression runs alongside decoding. Text is collected up to `buffer_size`
+# characters and handed to the thread in chunks through a bounded queue.
+class CompressedFile:
+    def __init__(self, path, compress, level=None, buffer_size=1 << 20):
+        header, self.compress, self.finish = COMPRESSORS[compress](level)
+        self.file = open(path, 'wb')
+        self.file.write(header)
+        self.buffer_size = buffer_size
+        self.chunks = []
+        self.size = 0
+        self.queue = queue.Queue(maxsize=4)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        chunk = ''
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    break
+                self.file.write(self.compress(chunk.encode()))
+            self.file.write(self.finish())
+        except BaseException as e:
+            self.error = e
+            # Keep draining so writers are not blocked on a full queue
+            while chunk is not None:
+                chunk = self.queue.get()
+        finally:
+            self.file.close()
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.queue.put(''.join(self.chunks))
+            self.chunks = []
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Open a CSV file for writing text, compressed according to `output`; `path`
+# is the full path, including any compression extension
+def open_csv_file(path, output):
+    if output.compress:
+        return CompressedFile(path, output.compress, output.compress_level, output.buffer_size)
+    return open(path, 'w', newline='', buffering=output.buffer_size)
+
+# Arrow type names for ROS primitive field types
+ARROW_TYPES = {
+    'boolean': 'bool_', 'byte': 'binary', 'octet': 'binary', 'char': 'string',
+    'float': 'float32', 'double': 'float64', 'long double': 'float64',
+    'int8': 'int8', 'uint8': 'uint8', 'int16': 'int16', 'uint16': 'uint16',
+    'int32': 'int32', 'uint32': 'uint32', 'int64': 'int64', 'uint64': 'uint64',
+    'string': 'string', 'wstring': 'string',
+}
+
+# Map a ROS field type string (e.g. 'double', 'double[9]', 'sequence<uint8>',
+# 'string<=10') to an Arrow type. Anything else, such as arrays of nested
+# messages, is written as its str().
+def arrow_type(pa, ros_type):
+    if ros_type is None:
+        return pa.string()
+    ros_type = re.sub(r'<=\d+$', '', ros_type)
+    if ros_type in ARROW_TYPES:
+        return getattr(pa, ARROW_TYPES[ros_type])()
+    match = re.fullmatch(r'(.+)\[(\d+)\]', ros_type)
+    if match and match.group(1) in ARROW_TYPES:
+        return pa.list_(arrow_type(pa, match.group(1)), int(match.group(2)))
+    match = re.fullmatch(r'sequence<([^,>]+)(?:, ?\d+)?>|(.+)\[<=\d+\]', ros_type)
+    if match and (match.group(1) or match.group(2)) in ARROW_TYPES:
+        return pa.list_(arrow_type(pa, match.group(1) or match.group(2)))
+    return pa.string()
+
+# Writes the rows of one topic to a CSV file. Rows are collected and formatted
+# in batches into an in-memory buffer, which goes to the file in large writes.
+# Given an offset, an uncompressed file written before is truncated there and
+# appended to instead; given a file, rows go to that open text stream.
+class CsvTopicWriter:
+    def __init__(self, path, columns, types, output, offset=None, file=None):
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text)
+        if file is not None:
+            self.file = file
+            self.writer.writerow(columns)
+        elif offset is None:
+            self.file = open_csv_file(path, output)
+            self.writer.writerow(columns)
+        else:
+            # Resume an existing file: drop anything past `offset` and append
+            os.truncate(path, offset)
+            self.file = open(path, 'a', newline='', buffering=output.buffer_size)
+        self.flush_rows = output.flush_rows
+        self.flush_bytes = output.flush_bytes
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_rows:
+            self.format()
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.flush_rows:
+            self.format()
+
+    # Format the collected rows, and write the text out once it is large enough
+    def format(self):
+        self.writer.writerows(self.rows)
+        self.rows = []
+        if self.text.tell() >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.writerows(self.rows)
+            self.rows = []
+        self.file.write(self.text.getvalue())
+        self.text.seek(0)
+        self.text.truncate()
+
+    # Write out everything collected so far; returns the file size
+    def sync(self):
+        self.flush()
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+# Writes the rows of one topic to a Parquet file with typed columns, one row
+# group per `row_group_size` rows
+class ParquetTopicWriter:
+    def __init__(self, path, columns, types, output, row_group_size=65536):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('pyarrow is required for Parquet output (pip install pyarrow)')
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([(column, arrow_type(pyarrow, ros_type))
+                                      for column, ros_type in zip(columns, types)])
+        self.stringify = [self.schema.field(i).type == pyarrow.string() and ros_type not in ('string', 'wstring', 'char')
+                          for i, ros_type in enumerate(types)]
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=output.compression)
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        arrays = []
+        for i, values in enumerate(zip(*self.rows)):
+            if self.stringify[i]:
+                values = [None if value is None else str(value) for value in values]
+            arrays.append(self.pa.array(values, type=self.schema.field(i).type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+WRITERS = {'csv': CsvTopicWriter, 'parquet': ParquetTopicWriter}
+
+# Path of an output file given the path without extension
+def output_path(path, output):
+    if output.format == 'csv' and output.compress:
+        return path + EXTENSIONS['csv'] + COMPRESSED_EXTENSIONS[output.compress]
+    return path + EXTENSIONS[output.format]
+
+# Open the writer for one topic; `path` is the output path without extension.
+# An offset resumes an uncompressed CSV file (see CsvTopicWriter).
+def open_writer(path, columns, types, output, offset=None):
+    if offset is not None:
+        return CsvTopicWriter(output_path(path, output), columns, types, output, offset)
+    return WRITERS[output.format](output_path(path, output), columns, types, output)
+
+# Concatenate Parquet files with the same schema into `path`, in order
+def concatenate_parquet(paths, path, output):
+    import pyarrow.parquet
+    writer = None
+    for part in paths:
+        part_file = pyarrow.parquet.ParquetFile(part)
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(path, part_file.schema_arrow, compression=output.compression)
+        for i in range(part_file.num_row_groups):
+            writer.write_table(part_file.read_row_group(i))
+    if writer is not None:
+        writer.close()